@@ -0,0 +1,188 @@
+import math
+import os
+import time
+from typing import Callable, Dict, Iterator, List, Optional
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+
+load_dotenv()
+
+APPROX_FRACTIONS = [float(f) for f in os.getenv("APPROX_FRACTIONS", "0.01,0.05,0.25,1.0").split(",")]
+APPROX_REPLICATES = int(os.getenv("APPROX_REPLICATES", 4))
+# Samples smaller than this are skipped; their estimates are too noisy to be useful.
+APPROX_MIN_SAMPLE_ROWS = int(os.getenv("APPROX_MIN_SAMPLE_ROWS", 1000))
+CONFIDENCE = 0.95
+Z_SCORE = 1.96
+
+
+def _strata(df: pd.DataFrame, stratify_by: Optional[str]) -> Optional[str]:
+    """The stratification column: the requested one, else the 'table_name' column of denormalized CSVs."""
+    if stratify_by and stratify_by in df.columns:
+        return stratify_by
+    if "table_name" in df.columns:
+        return "table_name"
+    return None
+
+
+def stratified_sample(df: pd.DataFrame, fraction: float, stratify_by: Optional[str] = None,
+                      seed: int = 0) -> pd.DataFrame:
+    """Samples `fraction` of the rows of every stratum, so small tables/groups stay represented."""
+    if fraction >= 1:
+        return df
+    column = _strata(df, stratify_by)
+    if column is None:
+        return df.sample(frac=fraction, random_state=seed)
+    return df.groupby(column, group_keys=False, sort=False).sample(frac=fraction, random_state=seed)
+
+
+def split_replicates(df: pd.DataFrame, replicates: int, stratify_by: Optional[str] = None) -> List[pd.DataFrame]:
+    """Splits a (shuffled) sample into disjoint replicates, each stratified like the sample itself."""
+    column = _strata(df, stratify_by)
+    if column is None:
+        group = np.arange(len(df)) % replicates
+    else:
+        group = df.groupby(column, sort=False).cumcount().to_numpy() % replicates
+    return [df[group == r] for r in range(replicates)]
+
+
+def _sample(data, fraction: float, stratify_by: Optional[str]):
+    if isinstance(data, dict):
+        return {name: stratified_sample(sheet, fraction, stratify_by) for name, sheet in data.items()}
+    return stratified_sample(data, fraction, stratify_by)
+
+
+def _replicates(data, replicates: int, stratify_by: Optional[str]) -> list:
+    if isinstance(data, dict):
+        split = {name: split_replicates(sheet, replicates, stratify_by) for name, sheet in data.items()}
+        return [{name: parts[r] for name, parts in split.items()} for r in range(replicates)]
+    return split_replicates(data, replicates, stratify_by)
+
+
+def _rows(data) -> int:
+    if isinstance(data, dict):
+        return sum(len(sheet) for sheet in data.values())
+    return len(data)
+
+
+def _to_frame(results: List[Dict]) -> Optional[pd.DataFrame]:
+    """Result records as a DataFrame with numeric-looking text (e.g. scalar results) converted, or None on error."""
+    if results and "error" in results[0]:
+        return None
+    df = pd.DataFrame(results)
+    for col in df.select_dtypes("object").columns:
+        converted = pd.to_numeric(df[col], errors="coerce")
+        if converted.notna().all():
+            df[col] = converted
+    return df
+
+
+def _align(full: pd.DataFrame, other: pd.DataFrame, keys: List[str]) -> Optional[pd.DataFrame]:
+    """Rows of `other` matching the rows of `full`, by key columns or else by position."""
+    if keys:
+        # e.g. an empty result of a filtered group-by on a small replicate has no columns at all
+        if any(k not in other.columns for k in keys):
+            return None
+        if full[keys].duplicated().any() or other[keys].duplicated().any():
+            return None
+        index = pd.Index(full[keys[0]]) if len(keys) == 1 else pd.MultiIndex.from_frame(full[keys])
+        return other.set_index(keys).reindex(index).reset_index(drop=True)
+    if len(other) != len(full):
+        return None
+    return other.reset_index(drop=True)
+
+
+def estimate(full: pd.DataFrame, replicates: List[Optional[pd.DataFrame]], fraction: float):
+    """
+    Scales the result computed on a sample and derives error bounds with the
+    random groups method: the spread of the same code run on disjoint
+    replicates of the sample.
+
+    A numeric column whose replicate values are about 1/R of the sample value
+    is treated as a total (count, sum) and scaled up by 1/fraction; other
+    columns (means, ratios, extremes) are reported as computed. Cells with no
+    counterpart in every replicate get no bound.
+    """
+    full = full.reset_index(drop=True)
+    result = full.copy()
+    bounds = pd.DataFrame(index=full.index)
+    numeric = list(full.select_dtypes("number").columns)
+    keys = [c for c in full.columns if c not in numeric]
+    aligned = [_align(full, rep, keys) if rep is not None else None for rep in replicates]
+    r = len(replicates)
+    for col in numeric:
+        values = [a[col].astype(float).to_numpy() if a is not None and col in a.columns else None for a in aligned]
+        if any(v is None for v in values) or r < 2:
+            bounds[col] = np.nan
+            continue
+        reps = np.vstack(values)
+        full_total = full[col].astype(float).sum()
+        ratio = np.nanmean(reps.sum(axis=1)) / full_total if full_total else 1.0
+        total_like = abs(ratio * r - 1) < abs(ratio - 1)
+        spread = np.nanstd(reps, axis=0, ddof=1)
+        if total_like:
+            result[col] = full[col].astype(float) / fraction
+            se = math.sqrt(r) * spread / fraction
+        else:
+            se = spread / math.sqrt(r)
+        se[np.isnan(reps).any(axis=0)] = np.nan
+        bounds[col] = Z_SCORE * se
+    return result, bounds
+
+
+def _records(df: pd.DataFrame) -> List[Dict]:
+    return df.astype(object).where(df.notna(), None).to_dict(orient="records")
+
+
+def progressive_execute(run: Callable[[object], List[Dict]], data, time_budget: float,
+                        stratify_by: Optional[str] = None) -> Iterator[Dict]:
+    """
+    Runs the generated code on growing stratified samples of `data` (a DataFrame
+    or a dict of sheets), yielding an estimate with error bounds after each step.
+    Stops once the answer is exact or the next step is predicted to exceed
+    `time_budget` seconds. `run` executes the code on a dataset and returns the
+    result records.
+    """
+    total_rows = _rows(data)
+    start = time.perf_counter()
+    last = None  # (fraction, seconds) of the previous step
+    fractions = sorted(set(APPROX_FRACTIONS + [1.0]))
+    for step, fraction in enumerate(fractions):
+        if fraction < 1 and total_rows * fraction < APPROX_MIN_SAMPLE_ROWS:
+            continue
+        elapsed = time.perf_counter() - start
+        if last and elapsed + last[1] * fraction / last[0] > time_budget:
+            break
+        step_start = time.perf_counter()
+        try:
+            sample = _sample(data, fraction, stratify_by)
+            records = run(sample)
+            full = _to_frame(records)
+            if full is None:
+                if fraction >= 1:
+                    yield {"step": step, "exact": True, "results": records}
+                # Sparse samples can break generated code (e.g. an empty filter); try a larger one
+                continue
+            if fraction >= 1:
+                result, bounds = full, pd.DataFrame(0.0, index=full.index, columns=full.select_dtypes("number").columns)
+            else:
+                replicates = [_to_frame(run(rep)) for rep in _replicates(sample, APPROX_REPLICATES, stratify_by)]
+                result, bounds = estimate(full, replicates, fraction)
+            last = (fraction, time.perf_counter() - step_start)
+            yield {
+                "step": step,
+                "exact": fraction >= 1,
+                "sample_fraction": fraction,
+                "sample_rows": _rows(sample),
+                "total_rows": total_rows,
+                "elapsed_ms": round((time.perf_counter() - start) * 1000, 2),
+                "confidence": CONFIDENCE,
+                "results": _records(result),
+                "error_bounds": _records(bounds),
+            }
+        except Exception as e:
+            # The response is already streaming, so a failed step is reported as a line of its own
+            yield {"step": step, "exact": fraction >= 1, "sample_fraction": fraction,
+                   "error": f"Estimation failed: {str(e)}"}
+        if fraction >= 1:
+            return
@@ -0,0 +1,71 @@
+import argparse
+import io
+import time
+import pandas as pd
+import query_log
+from query_templates import template_store
+
+
+def _measure(fn) -> dict:
+    wall, cpu = time.perf_counter(), time.process_time()
+    rows, size = fn()
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    return {
+        "rows": rows,
+        "bytes": size,
+        "seconds": round(wall, 3),
+        "rows_per_s": round(rows / wall) if wall else None,
+        "cpu_us_per_row": round(cpu * 1e6 / rows, 2) if rows else None,
+    }
+
+
+def bench(backend: str, sql: str, repeat: int = 3) -> dict:
+    """
+    Exports the result of `sql` as CSV through the regular dict-per-row path and
+    through the bulk export fast path, reporting throughput and client CPU per row.
+    """
+    if backend == "postgres":
+        from db_postgres import PostgresQueryAgent as Agent, AgentState
+        fast_name, fast = "copy", lambda agent, state: agent.copy_csv(state)
+    else:
+        from mysql_module import MySQLQueryAgent as Agent, AgentState
+        fast_name, fast = "tuple_batches", lambda agent, state: agent.iter_csv(state)
+    agent = Agent()
+
+    def regular():
+        state = agent.execute_query(AgentState(user_input="benchmark", sql_query=sql))
+        stream = io.StringIO()
+        pd.DataFrame(state.results).to_csv(stream, index=False)
+        return len(state.results), len(stream.getvalue().encode("utf-8"))
+
+    def fast_path():
+        size = newlines = 0
+        for chunk in fast(agent, AgentState(user_input="benchmark", sql_query=sql)):
+            size += len(chunk)
+            newlines += chunk.count(b"\n")
+        return newlines - 1, size
+
+    results = {}
+    for name, fn in (("dict_rows", regular), (fast_name, fast_path)):
+        runs = [_measure(fn) for _ in range(repeat)]
+        results[name] = min(runs, key=lambda r: r["seconds"])
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark CSV export paths for a SELECT statement.")
+    parser.add_argument("backend", choices=["postgres", "mysql"])
+    parser.add_argument("sql", help="SELECT statement to export (uses DB_URL / MYSQL_URL).")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per path; the fastest is reported.")
+    args = parser.parse_args(argv)
+
+    # Benchmark runs must not be logged or learned as templates
+    query_log.enabled = False
+    template_store.enabled = False
+    for name, stats in bench(args.backend, args.sql, args.repeat).items():
+        print(f"{name:>14}: {stats['rows']} rows, {stats['bytes']} bytes, {stats['seconds']} s, "
+              f"{stats['rows_per_s']} rows/s, {stats['cpu_us_per_row']} us CPU/row")
+
+
+if __name__ == "__main__":
+    main()
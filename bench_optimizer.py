@@ -0,0 +1,64 @@
+import argparse
+import time
+import pandas as pd
+from code_optimizer import optimize_code
+
+
+def _measure(fn) -> dict:
+    wall, cpu = time.perf_counter(), time.process_time()
+    result = fn()
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    return {"result": result, "seconds": round(wall, 4), "cpu_seconds": round(cpu, 4)}
+
+
+def _run(code: str, df: pd.DataFrame):
+    local_vars = {"df": df.copy(), "pd": pd}
+    exec(code, {}, local_vars)
+    result = local_vars.get("result")
+    if isinstance(result, pd.DataFrame):
+        return result.to_dict(orient="records")
+    return str(result)
+
+
+def bench(code: str, df: pd.DataFrame, repeat: int = 3) -> dict:
+    """
+    Runs pandas code as generated and as rewritten by optimize_code on `df`,
+    reporting the fastest run of each, whether their results are identical,
+    the rewrites applied and the columns the result was found to depend on.
+    """
+    optimized, touched, applied = optimize_code(code, list(df.columns))
+    results = {}
+    for name, source in (("original", code), ("optimized", optimized)):
+        runs = [_measure(lambda: _run(source, df)) for _ in range(repeat)]
+        results[name] = min(runs, key=lambda r: r["seconds"])
+    original, rewritten = results["original"], results["optimized"]
+    return {
+        "applied": applied,
+        "touched_columns": touched,
+        "identical": repr(original.pop("result")) == repr(rewritten.pop("result")),
+        "speedup": round(original["seconds"] / rewritten["seconds"], 2) if rewritten["seconds"] else None,
+        **results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark generated pandas code before and after optimize_code.")
+    parser.add_argument("data", help="CSV file loaded as `df`.")
+    parser.add_argument("code", help="Pandas code assigning `result`, or @path to a file containing it.")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per variant; the fastest is reported.")
+    args = parser.parse_args(argv)
+
+    code = args.code
+    if code.startswith("@"):
+        with open(code[1:], encoding="utf-8") as f:
+            code = f.read()
+    stats = bench(code, pd.read_csv(args.data), args.repeat)
+    print(f"   applied: {', '.join(stats['applied']) or 'none'}")
+    print(f"   touched: {stats['touched_columns']}")
+    for name in ("original", "optimized"):
+        print(f"{name:>10}: {stats[name]['seconds']} s, {stats[name]['cpu_seconds']} s CPU")
+    print(f"   speedup: {stats['speedup']}x, identical results: {stats['identical']}")
+
+
+if __name__ == "__main__":
+    main()
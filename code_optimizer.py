@@ -0,0 +1,433 @@
+import ast
+import copy
+import re
+from typing import List, Optional, Tuple
+
+# Methods that mutate their receiver, so an assignment calling them is not dead.
+MUTATING_METHODS = {"append", "extend", "insert", "pop", "popitem", "remove", "clear",
+                    "update", "setdefault", "sort", "reverse"}
+# Accesses that select columns positionally or dynamically, so the touched set is unknown.
+DYNAMIC_COLUMN_ACCESS = {"iloc", "iat", "columns", "select_dtypes", "filter", "itertuples"}
+VECTORIZABLE_BINOPS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow)
+VECTORIZABLE_CMPOPS = (ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE)
+QUERY_IDENTIFIER = re.compile(r"`([^`]+)`|([A-Za-z_]\w*)")
+# Local variables referenced from .query()/.eval() expression strings as @name.
+QUERY_VARIABLE = re.compile(r"@([A-Za-z_]\w*)")
+# Methods that evaluate expression strings against the caller's variables.
+EXPRESSION_METHODS = {"query", "eval"}
+# Methods whose output depends on every column unless a subset is given.
+WHOLE_ROW_METHODS = {"dropna", "drop_duplicates", "duplicated"}
+# Operations that combine the columns of their receiver. Unless the receiver is a
+# column projection, their result depends on every column.
+WHOLE_FRAME_ACCESS = {"corr", "cov", "corrwith", "sum", "mean", "median", "min", "max", "std", "var", "sem",
+                      "prod", "count", "nunique", "any", "all", "idxmax", "idxmin", "mode", "quantile",
+                      "cumsum", "cumprod", "cummax", "cummin", "diff", "pct_change", "rank", "apply",
+                      "applymap", "map", "agg", "aggregate", "transform", "pipe", "to_numpy", "values",
+                      "T", "transpose", "stack", "melt", "describe", "info", "memory_usage", "to_dict",
+                      "to_records", "to_string"}
+
+
+def _loaded_names(node) -> set:
+    """Names read by node, including @name references inside .query()/.eval() strings."""
+    names = set()
+    for n in ast.walk(node):
+        if isinstance(n, ast.Name) and isinstance(n.ctx, ast.Load):
+            names.add(n.id)
+        elif isinstance(n, ast.Constant) and isinstance(n.value, str):
+            names.update(QUERY_VARIABLE.findall(n.value))
+    return names
+
+
+def _stored_names(node) -> set:
+    return {n.id for n in ast.walk(node) if isinstance(n, ast.Name) and isinstance(n.ctx, ast.Store)}
+
+
+def _column_key(node, frame: str) -> Optional[str]:
+    """Return 'c' if node is frame['c'], else None."""
+    if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and node.value.id == frame:
+        if isinstance(node.slice, ast.Constant) and isinstance(node.slice.value, str):
+            return node.slice.value
+    return None
+
+
+def _vectorize(expr, row: str, frame: ast.Name):
+    """
+    Translate a row-wise expression over `row` into the equivalent column-wise
+    expression over `frame`, or return None if it cannot be done safely.
+    """
+    def convert(node):
+        key = _column_key(node, row)
+        if key is not None:
+            found.append(key)
+            return ast.Subscript(value=ast.Name(id=frame.id, ctx=ast.Load()),
+                                 slice=ast.Constant(value=key), ctx=ast.Load())
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float, str)):
+            return ast.Constant(value=node.value)
+        if isinstance(node, ast.BinOp) and isinstance(node.op, VECTORIZABLE_BINOPS):
+            left, right = convert(node.left), convert(node.right)
+            if left is not None and right is not None:
+                return ast.BinOp(left=left, op=node.op, right=right)
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            operand = convert(node.operand)
+            if operand is not None:
+                return ast.UnaryOp(op=node.op, operand=operand)
+        if isinstance(node, ast.Compare) and len(node.ops) == 1 \
+                and isinstance(node.ops[0], VECTORIZABLE_CMPOPS):
+            left, right = convert(node.left), convert(node.comparators[0])
+            if left is not None and right is not None:
+                return ast.Compare(left=left, ops=node.ops, comparators=[right])
+        return None
+
+    found = []
+    vectorized = convert(expr)
+    return vectorized if found else None
+
+
+def _dtype_guard(frame: str, dtypes: Tuple[str, ...]):
+    """Runtime test that every column of `frame` has one of `dtypes`, as an expression node."""
+    checks = " or ".join(f"({frame}.dtypes == '{d}').all()" for d in dtypes)
+    return ast.parse(f"not {frame}.empty and ({checks})", mode="eval").body
+
+
+def _integer_only(expr) -> bool:
+    """True if expr cannot produce floats from integer operands (no /, ** or float constants)."""
+    for node in ast.walk(expr):
+        if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.Div, ast.Pow)):
+            return False
+        if isinstance(node, ast.Constant) and isinstance(node.value, float):
+            return False
+    return True
+
+
+class _RowwiseVectorizer(ast.NodeTransformer):
+    """
+    Rewrites frame.apply(lambda r: <expr>, axis=1) into a vectorized expression.
+
+    apply() hands the lambda rows upcast to the frame's common dtype and returns
+    an unnamed Series (a DataFrame for an empty frame), so the vectorized form is
+    only used when, at runtime, the frame is non-empty and all of its columns
+    are float64 or all int64. Otherwise the original apply() runs.
+    """
+
+    def __init__(self, applied: List[str]):
+        self.applied = applied
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        func = node.func
+        if not (isinstance(func, ast.Attribute) and func.attr == "apply"
+                and isinstance(func.value, ast.Name) and len(node.args) == 1
+                and isinstance(node.args[0], ast.Lambda)):
+            return node
+        axis = [kw for kw in node.keywords if kw.arg == "axis"]
+        if len(node.keywords) != 1 or not axis or not isinstance(axis[0].value, ast.Constant) \
+                or axis[0].value.value not in (1, "columns"):
+            return node
+        lam = node.args[0]
+        if len(lam.args.args) != 1 or lam.args.vararg or lam.args.kwarg or lam.args.kwonlyargs:
+            return node
+        vectorized = _vectorize(lam.body, lam.args.args[0].arg, func.value)
+        if vectorized is None:
+            return node
+        self.applied.append(f"vectorized {func.value.id}.apply(axis=1)")
+        unnamed = ast.Call(func=ast.Attribute(value=vectorized, attr="rename", ctx=ast.Load()),
+                           args=[ast.Constant(value=None)], keywords=[])
+        return ast.IfExp(test=_dtype_guard(func.value.id, ("float64", "int64")), body=unnamed, orelse=node)
+
+
+def _vectorize_iterrows(body: list, applied: List[str]) -> list:
+    """
+    Rewrites
+        for _, row in frame.iterrows():
+            total += <expr over row>
+    into total += (<vectorized expr>).sum(), guarded to run only when every
+    column of the frame is int64 and the expression stays integral. Integer
+    sums are exact, so the order of additions does not matter; float sums
+    would round differently, so they keep the loop.
+    """
+    out = []
+    for i, stmt in enumerate(body):
+        rewritten = None
+        if isinstance(stmt, ast.For) and not stmt.orelse and len(stmt.body) == 1 \
+                and isinstance(stmt.iter, ast.Call) and not stmt.iter.args and not stmt.iter.keywords \
+                and isinstance(stmt.iter.func, ast.Attribute) and stmt.iter.func.attr == "iterrows" \
+                and isinstance(stmt.iter.func.value, ast.Name) \
+                and isinstance(stmt.target, ast.Tuple) and len(stmt.target.elts) == 2 \
+                and all(isinstance(e, ast.Name) for e in stmt.target.elts) \
+                and isinstance(stmt.body[0], ast.AugAssign) and isinstance(stmt.body[0].op, ast.Add) \
+                and isinstance(stmt.body[0].target, ast.Name) and _integer_only(stmt.body[0].value):
+            index_var, row_var = (e.id for e in stmt.target.elts)
+            aug = stmt.body[0]
+            later = set().union(*(_loaded_names(s) for s in body[i + 1:])) if body[i + 1:] else set()
+            if index_var not in _loaded_names(aug.value) and not ({index_var, row_var} & later):
+                vectorized = _vectorize(aug.value, row_var, stmt.iter.func.value)
+                if vectorized is not None:
+                    total = ast.Call(func=ast.Attribute(value=vectorized, attr="sum", ctx=ast.Load()),
+                                     args=[], keywords=[])
+                    rewritten = ast.If(test=_dtype_guard(stmt.iter.func.value.id, ("int64",)),
+                                       body=[ast.AugAssign(target=aug.target, op=ast.Add(), value=total)],
+                                       orelse=[stmt])
+                    applied.append(f"vectorized {stmt.iter.func.value.id}.iterrows() loop")
+        out.append(rewritten or stmt)
+    return out
+
+
+def _is_to_datetime_reassign(stmt) -> bool:
+    """Matches frame['c'] = pd.to_datetime(frame['c'], ...)."""
+    if not (isinstance(stmt, ast.Assign) and len(stmt.targets) == 1):
+        return False
+    target, value = stmt.targets[0], stmt.value
+    return (isinstance(target, ast.Subscript) and isinstance(value, ast.Call)
+            and isinstance(value.func, ast.Attribute) and value.func.attr == "to_datetime"
+            and len(value.args) == 1 and ast.dump(value.args[0]) == ast.dump(
+                ast.Subscript(value=target.value, slice=target.slice, ctx=ast.Load())))
+
+
+def _dedupe_to_datetime(body: list, applied: List[str]) -> list:
+    """Drops repeated pd.to_datetime conversions of a column that is already converted."""
+    # target dump -> (names the target reads, dump of the conversion call)
+    converted = {}
+    out = []
+    for stmt in body:
+        if _is_to_datetime_reassign(stmt):
+            key = ast.dump(stmt.targets[0])
+            if key in converted and converted[key][1] == ast.dump(stmt.value):
+                applied.append(f"removed repeated pd.to_datetime on {ast.unparse(stmt.targets[0])}")
+                continue
+            converted[key] = (_loaded_names(stmt.targets[0]), ast.dump(stmt.value))
+        elif not isinstance(stmt, (ast.Assign, ast.AugAssign, ast.AnnAssign)):
+            converted.clear()
+        else:
+            stored = _stored_names(stmt)
+            targets = stmt.targets if isinstance(stmt, ast.Assign) else [stmt.target]
+            dumps = {ast.dump(t) for t in targets}
+            converted = {k: v for k, v in converted.items() if k not in dumps and not (v[0] & stored)}
+        out.append(stmt)
+    return out
+
+
+def _merge_parts(value):
+    """Return (left, right, keys) for an inner merge on shared key columns, else None."""
+    if not isinstance(value, ast.Call) or not isinstance(value.func, ast.Attribute) \
+            or value.func.attr != "merge":
+        return None
+    kwargs = {kw.arg: kw.value for kw in value.keywords}
+    if None in kwargs or "on" not in kwargs or "left_on" in kwargs or "right_on" in kwargs:
+        return None
+    how = kwargs.get("how")
+    if how is not None and not (isinstance(how, ast.Constant) and how.value == "inner"):
+        return None
+    on = kwargs["on"]
+    if isinstance(on, ast.Constant) and isinstance(on.value, str):
+        keys = {on.value}
+    elif isinstance(on, ast.List) and all(isinstance(e, ast.Constant) and isinstance(e.value, str)
+                                          for e in on.elts):
+        keys = {e.value for e in on.elts}
+    else:
+        return None
+    if isinstance(value.func.value, ast.Name) and value.func.value.id != "pd" and len(value.args) == 1:
+        left, right = value.func.value, value.args[0]
+    elif isinstance(value.func.value, ast.Name) and value.func.value.id == "pd" and len(value.args) == 2:
+        left, right = value.args
+    else:
+        return None
+    if not (isinstance(left, ast.Name) and isinstance(right, ast.Name)):
+        return None
+    return left, right, keys
+
+
+def _key_only_filter(cond, frame: str, keys: set) -> bool:
+    """True if cond only reads key columns of frame, so it holds identically on both merge inputs."""
+    if _column_key(cond, frame) in keys:
+        return True
+    if isinstance(cond, ast.Compare) and len(cond.ops) == 1:
+        sides = [cond.left, cond.comparators[0]]
+        cols = [s for s in sides if _column_key(s, frame) in keys]
+        others = [s for s in sides if _column_key(s, frame) is None]
+        return len(cols) == 1 and len(others) == 1 and frame not in _loaded_names(others[0])
+    if isinstance(cond, ast.BinOp) and isinstance(cond.op, (ast.BitAnd, ast.BitOr)):
+        return _key_only_filter(cond.left, frame, keys) and _key_only_filter(cond.right, frame, keys)
+    if isinstance(cond, ast.UnaryOp) and isinstance(cond.op, ast.Invert):
+        return _key_only_filter(cond.operand, frame, keys)
+    if isinstance(cond, ast.Call) and isinstance(cond.func, ast.Attribute) and cond.func.attr == "isin" \
+            and _column_key(cond.func.value, frame) in keys and len(cond.args) == 1 and not cond.keywords:
+        return frame not in _loaded_names(cond.args[0])
+    return False
+
+
+class _RenameFrame(ast.NodeTransformer):
+    def __init__(self, old: str, new: str):
+        self.old, self.new = old, new
+
+    def visit_Name(self, node):
+        if node.id == self.old:
+            return ast.Name(id=self.new, ctx=node.ctx)
+        return node
+
+
+def _push_filters_below_merges(body: list, applied: List[str]) -> list:
+    """
+    Rewrites
+        m = a.merge(b, on='k')
+        m = m[m['k'] == v]
+    into m = a[a['k'] == v].merge(b[b['k'] == v], on='k'), so the join only sees
+    matching rows. Only inner merges filtered on their join keys are rewritten,
+    since only then the filter holds identically on both inputs.
+
+    The rewritten frame has a fresh index instead of the filtered merge's row
+    labels, so the rewrite is only applied when the filtered frame is the final
+    `result`, whose index is dropped when it is converted to records.
+    """
+    out = list(body)
+    for i in range(len(out) - 1):
+        first, second = out[i], out[i + 1]
+        if not (isinstance(first, ast.Assign) and len(first.targets) == 1
+                and isinstance(first.targets[0], ast.Name)
+                and isinstance(second, ast.Assign) and len(second.targets) == 1
+                and isinstance(second.targets[0], ast.Name) and second.targets[0].id == "result"):
+            continue
+        merged = first.targets[0].id
+        parts = _merge_parts(first.value)
+        if parts is None:
+            continue
+        left, right, keys = parts
+        sub = second.value
+        if not (isinstance(sub, ast.Subscript) and isinstance(sub.value, ast.Name) and sub.value.id == merged
+                and _key_only_filter(sub.slice, merged, keys)):
+            continue
+        later = out[i + 2:]
+        if any({merged, "result"} & (_loaded_names(s) | _stored_names(s)) for s in later):
+            continue
+        if merged in (left.id, right.id) or left.id == right.id:
+            continue
+        new_value = copy.deepcopy(first.value)
+        method_form = new_value.func.value.id == left.id
+        for side in (left, right):
+            cond = _RenameFrame(merged, side.id).visit(copy.deepcopy(sub.slice))
+            filtered = ast.Subscript(value=ast.Name(id=side.id, ctx=ast.Load()), slice=cond, ctx=ast.Load())
+            if method_form and side is left:
+                new_value.func.value = filtered
+            else:
+                new_value.args = [filtered if isinstance(a, ast.Name) and a.id == side.id else a
+                                  for a in new_value.args]
+        out[i] = ast.Assign(targets=[ast.Name(id=second.targets[0].id, ctx=ast.Store())], value=new_value)
+        out[i + 1] = ast.Pass()
+        applied.append(f"pushed filter on {', '.join(sorted(keys))} below merge of {left.id} and {right.id}")
+    return [s for s in out if not isinstance(s, ast.Pass)]
+
+
+def _is_pure_assign(stmt) -> bool:
+    if not (isinstance(stmt, ast.Assign) and all(isinstance(t, ast.Name) for t in stmt.targets)):
+        return False
+    for node in ast.walk(stmt.value):
+        if isinstance(node, (ast.NamedExpr, ast.Yield, ast.YieldFrom, ast.Await)):
+            return False
+        if isinstance(node, ast.keyword) and node.arg == "inplace":
+            return False
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) \
+                and node.func.attr in MUTATING_METHODS:
+            return False
+    return True
+
+
+def _drop_dead_assignments(body: list, applied: List[str]) -> list:
+    """Removes top-level assignments whose value never reaches `result`."""
+    if not any("result" in _stored_names(s) for s in body):
+        return body
+    # Expression strings may be built at runtime, so their variable reads cannot be traced
+    if any(isinstance(n, ast.Attribute) and n.attr in EXPRESSION_METHODS for s in body for n in ast.walk(s)):
+        return body
+    live = {"result"}
+    kept = []
+    for stmt in reversed(body):
+        targets = {t.id for t in stmt.targets} if _is_pure_assign(stmt) else None
+        if targets is not None and not (targets & live):
+            applied.append(f"removed dead assignment to {', '.join(sorted(targets))}")
+            continue
+        if targets is not None:
+            live -= targets
+        live |= _loaded_names(stmt)
+        kept.append(stmt)
+    return list(reversed(kept))
+
+
+def _is_projection(node) -> bool:
+    """
+    True if node selects named columns, e.g. frame[['a', 'b']] or frame['a'],
+    possibly followed by attribute accesses and method calls with constant
+    arguments, which cannot bring other columns back in.
+    """
+    while True:
+        if isinstance(node, ast.Attribute):
+            node = node.value
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) \
+                and not any(_loaded_names(a) for a in node.args + [kw.value for kw in node.keywords]):
+            node = node.func.value
+        else:
+            break
+    if not isinstance(node, ast.Subscript):
+        return False
+    key = node.slice
+    names = key.elts if isinstance(key, (ast.List, ast.Tuple)) else [key]
+    return bool(names) and all(isinstance(n, ast.Constant) and isinstance(n.value, str) for n in names)
+
+
+def _touched_columns(tree, columns: Optional[list]) -> Optional[List[str]]:
+    """
+    Columns the result depends on, or None if that is unknown. Known only when
+    the final `result` is an explicit column projection; whole-frame results
+    (filters, groupby aggregates, head(), describe() ...) need every column,
+    and so do whole-frame operations anywhere in the code (df.corr(),
+    df.sum(axis=1), df.values ...) unless applied to a projection.
+    """
+    if columns is None:
+        return None
+    stores = [i for i, s in enumerate(tree.body) if "result" in _stored_names(s)]
+    if not stores:
+        return None
+    final = tree.body[stores[-1]]
+    if not (isinstance(final, ast.Assign) and len(final.targets) == 1 and _is_projection(final.value)):
+        return None
+    # Later writes such as result['c'] = ... can add columns
+    if any("result" in _loaded_names(s) for s in tree.body[stores[-1] + 1:]):
+        return None
+    referenced = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Attribute) and node.attr in DYNAMIC_COLUMN_ACCESS:
+            return None
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) \
+                and node.func.attr in WHOLE_ROW_METHODS and not any(kw.arg == "subset" for kw in node.keywords):
+            return None
+        if isinstance(node, ast.Attribute) and node.attr in WHOLE_FRAME_ACCESS and not _is_projection(node.value):
+            return None
+        if isinstance(node, ast.Attribute):
+            referenced.add(node.attr)
+        if isinstance(node, ast.Constant) and isinstance(node.value, str):
+            referenced.add(node.value)
+            # Column names used inside .query()/.eval() expression strings
+            referenced.update(quoted or bare for quoted, bare in QUERY_IDENTIFIER.findall(node.value))
+    return [col for col in columns if str(col) in referenced]
+
+
+def optimize_code(code: str, columns: Optional[list] = None) -> Tuple[str, Optional[List[str]], List[str]]:
+    """
+    Applies conservative AST rewrites to generated pandas code before it is executed.
+
+    Returns the (possibly unchanged) code, the subset of `columns` the result
+    depends on (None if unknown), and a description of each rewrite applied.
+    Raises SyntaxError if the code does not parse.
+    """
+    tree = ast.parse(code)
+    # Taken from the code as written; the rewrites change how columns are read, not which
+    touched = _touched_columns(tree, columns)
+    applied = []
+    tree = _RowwiseVectorizer(applied).visit(tree)
+    body = _vectorize_iterrows(tree.body, applied)
+    body = _dedupe_to_datetime(body, applied)
+    body = _push_filters_below_merges(body, applied)
+    body = _drop_dead_assignments(body, applied)
+    tree.body = body
+    ast.fix_missing_locations(tree)
+    if not applied:
+        return code, touched, applied
+    return ast.unparse(tree), touched, applied
@@ -1,13 +1,24 @@
 from langgraph.graph import StateGraph, END, START
 from pydantic import BaseModel
 from typing import List, Dict, Optional
+import time
 import pandas as pd
 from utils import llm_invoke, get_csv_schema
+from scheduler import QueueFullError
+from code_optimizer import optimize_code
+import query_log
+from query_templates import template_store
 
 class AgentState(BaseModel):
     user_input: str
     sql_query: Optional[str] = None
     results: List[Dict] = []
+    touched_columns: Optional[List[str]] = None
+    generation_ms: Optional[float] = None
+    sql_params: Optional[Dict] = None
+    template_hit: bool = False
+    # Set when a template hit failed or found no rows; the code is then regenerated by the LLM
+    template_rejected: bool = False
     csv_schema: str  
     df: pd.DataFrame
 
@@ -26,6 +37,16 @@ class CSVQueryAgent:
         Generates pandas code using LLM based on the user input and CSV schema.
         """
         schema = state.csv_schema
+        # Reuse a learned template for questions of a known shape instead of calling the LLM
+        template = None if state.template_rejected else template_store.match("csv", schema, state.user_input)
+        state.template_hit = False
+        state.sql_params = None
+        state.results = []
+        if template:
+            state.sql_query = template["query"]
+            state.sql_params = template["params"]
+            state.template_hit = True
+            return state
         prompt = f"""
 Given the following CSV schema:
 {schema}
@@ -50,28 +71,40 @@ Write valid Python code using pandas that answers the following request.
 Request: '{state.user_input}'
 """
         try:
+            start = time.perf_counter()
             code = llm_invoke(prompt)
+            state.generation_ms = query_log.elapsed_ms(start)
             code = code.strip()
             if code.startswith("```"):
                 code = code.lstrip("`").replace("python", "", 1).strip().rstrip("`").strip()
             state.sql_query = code
             # print("Generated code:", state.sql_query)
             return state
+        except QueueFullError:
+            raise
         except Exception as e:
             state.results = [{"error": f"Code generation failed: {str(e)}"}]
             return state
 
-    def execute_pandas_code(self, state: AgentState) -> AgentState:
+    def run_pandas_code(self, state: AgentState) -> AgentState:
         """
-        Executes the generated pandas code safely and updates the state with results or errors.
+        Executes the generated code and stores its results or error on the state,
+        without learning templates or logging. Also used for sampled runs.
         """
         df = state.df
         code = (state.sql_query or "").strip()
         if code.startswith("```"):
             code = code.lstrip("`").replace("python", "", 1).strip().rstrip("`").strip()
         local_vars = {"df": df, "pd": pd}
+        # Template parameters are globals so lambdas and comprehensions in the code can see them
+        global_vars = dict(state.sql_params or {})
+        try:
+            # Errors keep reporting the code as generated; only the optimized copy is executed.
+            exec_code, state.touched_columns, _ = optimize_code(code, list(df.columns))
+        except SyntaxError:
+            exec_code = code
         try:
-            exec(code, {}, local_vars)
+            exec(exec_code, global_vars, local_vars)
             result = local_vars.get("result", None)
             if isinstance(result, pd.DataFrame):
                 state.results = result.to_dict(orient="records")
@@ -85,6 +118,34 @@ Request: '{state.user_input}'
             state.results = [{"error": f"Execution error: {str(e)}", "code": code}]
         return state
 
+    def execute_pandas_code(self, state: AgentState) -> AgentState:
+        """
+        Executes the generated pandas code safely and updates the state with results or errors.
+        A template hit that fails or finds no rows is regenerated by the LLM and run again.
+        """
+        start = time.perf_counter()
+        state = self.run_pandas_code(state)
+        execution_ms = query_log.elapsed_ms(start)
+        code = (state.sql_query or "").strip()
+        if code.startswith("```"):
+            code = code.lstrip("`").replace("python", "", 1).strip().rstrip("`").strip()
+        failed = bool(state.results) and "error" in state.results[0]
+        if state.template_hit and (failed or not state.results):
+            template_store.reject("csv", state.csv_schema, code)
+            if failed:
+                template_store.forget("csv", state.csv_schema, code)
+            state.template_rejected = True
+        elif state.results and not failed and not state.template_hit:
+            template_store.learn("csv", state.csv_schema, state.user_input, code, state.generation_ms)
+        query_log.record("csv", state.user_input, query_log.schema_fingerprint(state.csv_schema), code,
+                         state.generation_ms, execution_ms, state.results,
+                         params=state.sql_params, touched_columns=state.touched_columns)
+        if state.template_hit and state.template_rejected:
+            state = self.generate_pandas_code(state)
+            if not state.results:
+                state = self.execute_pandas_code(state)
+        return state
+
     def get_workflow(self):
         """Define the workflow for the agent."""
         workflow = StateGraph(AgentState)
@@ -3,9 +3,18 @@ from pydantic import BaseModel
 from typing import List, Dict, Optional
 import psycopg2
 import psycopg2.extras
+import psycopg2.extensions
+import contextvars
+import queue
+import threading
 import os
+import time
+import uuid
 from urllib.parse import urlparse
-from utils import llm_invoke
+from utils import llm_invoke, clean_select
+from scheduler import admit, QueueFullError
+import query_log
+from query_templates import template_store
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -14,9 +23,43 @@ class AgentState(BaseModel):
     user_input: str
     sql_query: Optional[str] = ""
     results: List[Dict] = []
+    schema_fingerprint: Optional[str] = None
+    generation_ms: Optional[float] = None
+    db_schema: Optional[str] = None
+    sql_params: Optional[Dict] = None
+    template_hit: bool = False
+    # Set when a template hit failed or found no rows; the query is then regenerated by the LLM
+    template_rejected: bool = False
 
     model_config = {"arbitrary_types_allowed": True}
 
+class _ChunkWriter:
+    """
+    File-like sink for copy_expert. psycopg2 writes one CSV row per call, so rows
+    are buffered into chunks of about `chunk_size` bytes before being handed on.
+    """
+
+    def __init__(self, put, chunk_size: int):
+        self.put = put
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data.encode("utf-8") if isinstance(data, str) else data
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.buffer:
+            self.put(bytes(self.buffer))
+            self.buffer = bytearray()
+
+
+class _StreamAbandoned(Exception):
+    pass
+
+
 class PostgresQueryAgent:
     """
     Agent for generating and executing SQL queries on a PostgreSQL database using LLM.
@@ -44,27 +87,41 @@ class PostgresQueryAgent:
     def get_schema(self) -> str:
         if not self.db_config:
             raise RuntimeError("Database URL not provided. Please upload a CSV or Excel file instead.")
-        conn = self.get_db_conn()
-        cursor = conn.cursor()
-        try:
-            cursor.execute("""
-                SELECT table_name, column_name
-                FROM information_schema.columns
-                WHERE table_schema = 'public'
-            """)
-            schema = {}
-            for table, column in cursor.fetchall():
-                schema.setdefault(table, []).append(column)
-            schema_lines = ["Tables and columns:"]
-            for table, columns in schema.items():
-                schema_lines.append(f"{table}: {', '.join(columns)}")
-            return "\n".join(schema_lines)
-        finally:
-            cursor.close()
-            conn.close()
+        # Schema lookups open a connection too, so they go through admission control
+        with admit("postgres"):
+            conn = self.get_db_conn()
+            cursor = conn.cursor()
+            try:
+                cursor.execute("""
+                    SELECT table_name, column_name
+                    FROM information_schema.columns
+                    WHERE table_schema = 'public'
+                """)
+                schema = {}
+                for table, column in cursor.fetchall():
+                    schema.setdefault(table, []).append(column)
+                schema_lines = ["Tables and columns:"]
+                for table, columns in schema.items():
+                    schema_lines.append(f"{table}: {', '.join(columns)}")
+                return "\n".join(schema_lines)
+            finally:
+                cursor.close()
+                conn.close()
 
     def generate_sql(self, state: AgentState) -> AgentState:
         schema = self.get_schema()
+        state.schema_fingerprint = query_log.schema_fingerprint(schema)
+        state.db_schema = schema
+        # Reuse a learned template for questions of a known shape instead of calling the LLM
+        template = None if state.template_rejected else template_store.match("postgres", schema, state.user_input)
+        state.template_hit = False
+        state.sql_params = None
+        state.results = []
+        if template:
+            state.sql_query = template["query"]
+            state.sql_params = template["params"]
+            state.template_hit = True
+            return state
         # Extract table names for prompt clarity
         table_names = []
         for line in schema.splitlines():
@@ -96,12 +153,16 @@ Return ONLY the SQL query, no explanations, no comments, no markdown, no code fe
 Request: '{state.user_input}'
 """
         try:
+            start = time.perf_counter()
             sql_query = llm_invoke(prompt)
+            state.generation_ms = query_log.elapsed_ms(start)
             sql_query = sql_query.strip()
             if sql_query.startswith("```"):
                 sql_query = sql_query.lstrip("`").replace("sql", "", 1).strip().rstrip("`").strip()
             state.sql_query = sql_query
             return state
+        except QueueFullError:
+            raise
         except Exception as e:
             state.results = [{"error": f"SQL generation failed: {str(e)}"}]
             return state
@@ -110,21 +171,175 @@ Request: '{state.user_input}'
         sql = (state.sql_query or "").strip()
         if sql.startswith("```"):
             sql = sql.lstrip("`").replace("sql", "", 1).strip().rstrip("`").strip()
+        execution_ms, plan = None, None
         try:
+            with admit("postgres"):
+                conn = self.get_db_conn()
+                cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+                try:
+                    start = time.perf_counter()
+                    cursor.execute(sql, state.sql_params or None)
+                    results = cursor.fetchall()
+                    execution_ms = query_log.elapsed_ms(start)
+                    state.results = results
+                    if query_log.wants_plan(execution_ms):
+                        plan = self.explain(conn, sql, state.sql_params)
+                except Exception as e:
+                    execution_ms = query_log.elapsed_ms(start)
+                    state.results = [{"error": f"SQL execution failed: {str(e)}", "query": sql}]
+                finally:
+                    cursor.close()
+                    conn.close()
+        except QueueFullError:
+            raise
+        except Exception as e:
+            state.results = [{"error": f"Database connection failed: {str(e)}"}]
+        self.track_execution(state, sql, execution_ms, plan)
+        if state.template_hit and state.template_rejected:
+            state = self.generate_sql(state)
+            if not state.results:
+                state = self.execute_query(state)
+        return state
+
+    def track_execution(self, state: AgentState, sql: str, execution_ms: Optional[float],
+                        plan: Optional[str] = None, row_count: Optional[int] = None):
+        """
+        Rejects a template hit that failed (forgetting the template) or found no rows,
+        learns a template from a successful generation and logs slow executions.
+        `row_count` is given for results that were streamed rather than stored in
+        state.results.
+        """
+        failed = bool(state.results) and "error" in state.results[0]
+        if row_count is None:
+            row_count = len(state.results)
+        if state.template_hit and (failed or not row_count):
+            template_store.reject("postgres", state.db_schema, sql)
+            if failed:
+                template_store.forget("postgres", state.db_schema, sql)
+            state.template_rejected = True
+        elif row_count and not failed and not state.template_hit:
+            template_store.learn("postgres", state.db_schema, state.user_input, sql, state.generation_ms)
+        query_log.record("postgres", state.user_input, state.schema_fingerprint, sql, state.generation_ms,
+                         execution_ms, state.results, plan, state.sql_params, row_count)
+
+    def iter_query(self, state: AgentState, batch_size: int = 10000, on_connect=None, on_columns=None):
+        """
+        Executes the generated SQL with a server-side cursor and yields the rows in
+        batches, so large results never have to be held in memory at once.
+        `on_connect` is called with the open connection, e.g. to allow cancelling,
+        and `on_columns` with the result column names once the query has run.
+        """
+        sql = (state.sql_query or "").strip()
+        if sql.startswith("```"):
+            sql = sql.lstrip("`").replace("sql", "", 1).strip().rstrip("`").strip()
+        with admit("postgres"):
             conn = self.get_db_conn()
-            cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+            if on_connect:
+                on_connect(conn)
+            cursor = conn.cursor(name=f"stream_{uuid.uuid4().hex}", cursor_factory=psycopg2.extras.RealDictCursor)
             try:
-                cursor.execute(sql)
-                results = cursor.fetchall()
-                state.results = results
-            except Exception as e:
-                state.results = [{"error": f"SQL execution failed: {str(e)}", "query": sql}]
+                cursor.execute(sql, state.sql_params or None)
+                rows = cursor.fetchmany(batch_size)
+                # Read after the first fetch: a server-side cursor has no description before it
+                if on_columns and cursor.description:
+                    on_columns([d[0] for d in cursor.description])
+                while rows:
+                    yield rows
+                    rows = cursor.fetchmany(batch_size)
             finally:
                 cursor.close()
                 conn.close()
+
+    def copy_csv(self, state: AgentState, chunk_size: int = 1 << 16):
+        """
+        Streams the result of the generated SELECT as CSV encoded by the server via
+        COPY (...) TO STDOUT WITH CSV HEADER, so rows never become Python objects.
+        The COPY runs in a producer thread; chunks are handed over through a bounded
+        queue, and abandoning the iterator aborts the COPY and frees the connection.
+        Like execute_query, the execution is logged and updates the template store.
+        """
+        sql = clean_select(state.sql_query)
+        if sql is None:
+            raise ValueError("Only a single SELECT statement can be exported with COPY.")
+        chunks = queue.Queue(maxsize=16)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    chunks.put(item, timeout=0.5)
+                    return
+                except queue.Full:
+                    continue
+            raise _StreamAbandoned()
+
+        def produce():
+            try:
+                with admit("postgres"):
+                    conn = self.get_db_conn()
+                    try:
+                        cursor = conn.cursor()
+                        query = sql
+                        if state.sql_params:
+                            # Bind template parameters with the driver's own quoting
+                            encoding = psycopg2.extensions.encodings[conn.encoding]
+                            query = cursor.mogrify(sql, state.sql_params).decode(encoding)
+                        writer = _ChunkWriter(put, chunk_size)
+                        start = time.perf_counter()
+                        try:
+                            cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH CSV HEADER", writer)
+                            writer.flush()
+                        except _StreamAbandoned:
+                            raise
+                        except Exception as e:
+                            failed = state.model_copy(update={"results": [{"error": f"SQL execution failed: {str(e)}", "query": sql}]})
+                            self.track_execution(failed, sql, query_log.elapsed_ms(start))
+                            raise
+                        # Includes time spent waiting on the client, since the COPY is paced by it
+                        execution_ms = query_log.elapsed_ms(start)
+                        plan = self.explain(conn, sql, state.sql_params) if query_log.wants_plan(execution_ms) else None
+                        self.track_execution(state.model_copy(update={"results": []}), sql, execution_ms, plan,
+                                             row_count=max(cursor.rowcount, 0))
+                    finally:
+                        conn.close()
+                put(None)
+            except _StreamAbandoned:
+                pass
+            except Exception as e:
+                try:
+                    put(e)
+                except _StreamAbandoned:
+                    pass
+
+        # The producer inherits the caller's scheduler client context
+        thread = threading.Thread(target=contextvars.copy_context().run, args=(produce,), daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = chunks.get()
+                if item is None:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+
+    def explain(self, conn, sql: str, params: Optional[Dict] = None) -> str:
+        """
+        Returns the EXPLAIN (ANALYZE, BUFFERS) output for sql. The statement is run inside a
+        transaction that is rolled back, so it has no lasting side effects.
+        """
+        cursor = conn.cursor()
+        try:
+            conn.rollback()
+            cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS) {sql}", params or None)
+            return "\n".join(str(row[0]) for row in cursor.fetchall())
         except Exception as e:
-            state.results = [{"error": f"Database connection failed: {str(e)}"}]
-        return state
+            return f"EXPLAIN failed: {str(e)}"
+        finally:
+            cursor.close()
+            conn.rollback()
 
     def get_workflow(self):
         """Define the workflow for the agent."""
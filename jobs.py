@@ -0,0 +1,300 @@
+import glob
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional
+import pandas as pd
+from dotenv import load_dotenv
+import query_log
+from scheduler import client_context, QueueFullError
+
+load_dotenv()
+
+JOB_DIR = os.getenv("JOB_DIR", "job_results")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 4))
+JOB_TTL_SECONDS = float(os.getenv("JOB_TTL_SECONDS", 3600))
+JOB_BATCH_ROWS = int(os.getenv("JOB_BATCH_ROWS", 10000))
+# Running jobs older than this are cancelled and marked failed, so a hung worker cannot keep them forever.
+JOB_MAX_RUNTIME_SECONDS = float(os.getenv("JOB_MAX_RUNTIME_SECONDS", 6 * 3600))
+# How long a job keeps retrying while its backend's queue is full before it fails.
+JOB_QUEUE_WAIT_SECONDS = float(os.getenv("JOB_QUEUE_WAIT_SECONDS", 600))
+
+QUEUED, RUNNING, SUCCEEDED, FAILED, CANCELLED = "queued", "running", "succeeded", "failed", "cancelled"
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    """
+    A question answered in the background. Results are spilled to JOB_DIR/<id>
+    as numbered Parquet part files while they stream in.
+    """
+
+    def __init__(self, kind: str, question: str):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.question = question
+        self.status = QUEUED
+        self.rows = 0
+        self.parts = 0
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.dir = os.path.join(JOB_DIR, self.id)
+        self.cancel_event = threading.Event()
+        self.cancel_hook = None
+        # Result column names, if known before any row arrives (so empty results still get a header)
+        self.columns = None
+
+    def to_dict(self) -> Dict:
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "question": self.question,
+            "status": self.status,
+            "rows": self.rows,
+            "error": self.error,
+            "created": self.created,
+            "finished": self.finished,
+            "expires": self.finished + JOB_TTL_SECONDS if self.finished else None,
+        }
+
+    def part_paths(self) -> List[str]:
+        return sorted(glob.glob(os.path.join(self.dir, "part-*.parquet")))
+
+    def spill(self, rows: List[Dict]):
+        """Writes one batch of result rows as the next Parquet part file."""
+        if self.cancel_event.is_set():
+            raise JobCancelled()
+        df = pd.DataFrame(rows)
+        path = os.path.join(self.dir, f"part-{self.parts:05d}.parquet")
+        # Written under a temporary name so partial-result readers never see a half-written part
+        tmp = f"{path}.tmp"
+        try:
+            df.to_parquet(tmp, index=False)
+        except (ValueError, TypeError):
+            # Mixed-type object columns cannot be stored as one Arrow type; the
+            # nullable string dtype keeps None/NaN as nulls instead of "None"/"nan"
+            mixed = df.select_dtypes("object")
+            df[mixed.columns] = mixed.astype("string")
+            df.to_parquet(tmp, index=False)
+        os.replace(tmp, path)
+        self.parts += 1
+        self.rows += len(rows)
+
+    def iter_frames(self) -> Iterator[pd.DataFrame]:
+        paths = self.part_paths()
+        if not paths and self.columns:
+            yield pd.DataFrame(columns=self.columns)
+        for path in paths:
+            yield pd.read_parquet(path)
+
+    def head(self, limit: int) -> pd.DataFrame:
+        """The first `limit` result rows spilled so far. Reads Parquet; call it off the event loop."""
+        frames, count = [], 0
+        for frame in self.iter_frames():
+            frames.append(frame.head(limit - count))
+            count += len(frames[-1])
+            if count >= limit:
+                break
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+
+class JobManager:
+    """
+    Runs jobs on a bounded worker pool and expires finished results after
+    JOB_TTL_SECONDS, jobs running longer than JOB_MAX_RUNTIME_SECONDS, and job
+    directories left behind by earlier processes.
+    """
+
+    def __init__(self, workers: int = JOB_WORKERS):
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, kind: str, question: str, client_id: str,
+               run: Callable[[Job], Iterator[List[Dict]]], upload=None, upload_name: str = None) -> Job:
+        """
+        Queues `run`, a function returning an iterator of row batches for the job.
+        Jobs run in the batch priority class of the scheduler. An uploaded file
+        object is copied into the job directory as `upload_name` first.
+        """
+        self.expire()
+        job = Job(kind, question)
+        os.makedirs(job.dir, exist_ok=True)
+        if upload is not None:
+            with open(os.path.join(job.dir, upload_name), "wb") as f:
+                shutil.copyfileobj(upload, f)
+        with self._lock:
+            self._jobs[job.id] = job
+        self._pool.submit(self._run, job, client_id, run)
+        return job
+
+    def _run(self, job: Job, client_id: str, run):
+        if job.cancel_event.is_set():
+            return
+        job.status, job.started = RUNNING, time.time()
+        status, error = SUCCEEDED, None
+        try:
+            with client_context(client_id, "batch"):
+                self._spill_all(job, run)
+        except JobCancelled:
+            status = CANCELLED
+        except Exception as e:
+            status, error = (CANCELLED if job.cancel_event.is_set() else FAILED), str(e)
+        # A job that expire() already failed for running too long keeps that outcome
+        if job.status == RUNNING:
+            job.status, job.error, job.finished = status, error, time.time()
+
+    def _spill_all(self, job: Job, run):
+        """
+        Spills the batches of `run`. A batch job has no client waiting on it, so a
+        full backend queue is waited out (retrying the job from the start) for up
+        to JOB_QUEUE_WAIT_SECONDS instead of failing it.
+        """
+        deadline = time.monotonic() + JOB_QUEUE_WAIT_SECONDS
+        while True:
+            try:
+                for rows in run(job):
+                    job.spill(rows)
+                return
+            except QueueFullError as e:
+                # Admission happens before any rows arrive; a job that already spilled cannot restart
+                if job.parts or time.monotonic() + e.retry_after > deadline:
+                    raise
+                if job.cancel_event.wait(e.retry_after):
+                    raise JobCancelled()
+
+    def get(self, job_id: str) -> Optional[Job]:
+        self.expire()
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> Optional[Job]:
+        """Cancels a queued or running job, or deletes the results of a finished one."""
+        job = self.get(job_id)
+        if job is None:
+            return None
+        if job.status in (QUEUED, RUNNING):
+            job.cancel_event.set()
+            if job.status == QUEUED:
+                job.status = CANCELLED
+                job.finished = time.time()
+            elif job.cancel_hook:
+                try:
+                    job.cancel_hook()
+                except Exception:
+                    pass
+        else:
+            self._remove(job)
+        return job
+
+    def _remove(self, job: Job):
+        with self._lock:
+            self._jobs.pop(job.id, None)
+        shutil.rmtree(job.dir, ignore_errors=True)
+
+    def expire(self):
+        now = time.time()
+        with self._lock:
+            expired = [j for j in self._jobs.values() if j.finished and now - j.finished > JOB_TTL_SECONDS]
+            stuck = [j for j in self._jobs.values()
+                     if j.status == RUNNING and j.started and now - j.started > JOB_MAX_RUNTIME_SECONDS]
+            known = {j.id for j in self._jobs.values()}
+        for job in expired:
+            self._remove(job)
+        for job in stuck:
+            job.cancel_event.set()
+            if job.cancel_hook:
+                try:
+                    job.cancel_hook()
+                except Exception:
+                    pass
+            job.status, job.error = FAILED, f"Job exceeded the maximum runtime of {JOB_MAX_RUNTIME_SECONDS:.0f} seconds."
+            job.finished = now
+        self._remove_orphans(known, now)
+
+    def _remove_orphans(self, known: set, now: float):
+        """Deletes job directories no job of this process owns, e.g. from before a restart, once they reach the TTL."""
+        try:
+            entries = list(os.scandir(JOB_DIR))
+        except OSError:
+            return
+        for entry in entries:
+            try:
+                if entry.is_dir() and entry.name not in known and now - entry.stat().st_mtime > JOB_TTL_SECONDS:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+            except OSError:
+                pass
+
+
+def sql_job(agent, state) -> Callable[[Job], Iterator[List[Dict]]]:
+    """
+    Job body for the Postgres and MySQL agents: generate the SQL, then stream its
+    rows. Like execute_query, the execution is logged and updates the template
+    store, and a template hit that fails or finds no rows is regenerated.
+    """
+    def run(job: Job):
+        def on_connect(conn):
+            job.cancel_hook = getattr(conn, "cancel", None)
+
+        def on_columns(columns):
+            job.columns = columns
+
+        current = state
+        while True:
+            generated = agent.generate_sql(current)
+            if generated.results and "error" in generated.results[0]:
+                raise RuntimeError(generated.results[0]["error"])
+            sql = (generated.sql_query or "").strip()
+            if sql.startswith("```"):
+                sql = sql.lstrip("`").replace("sql", "", 1).strip().rstrip("`").strip()
+            rows = 0
+            start = time.perf_counter()
+            try:
+                for batch in agent.iter_query(generated, batch_size=JOB_BATCH_ROWS, on_connect=on_connect,
+                                              on_columns=on_columns):
+                    rows += len(batch)
+                    yield [dict(row) for row in batch]
+            except QueueFullError:
+                raise
+            except Exception as e:
+                if job.cancel_event.is_set():
+                    raise
+                tracked = generated.model_copy(update={"results": [{"error": f"SQL execution failed: {str(e)}", "query": sql}]})
+                agent.track_execution(tracked, sql, query_log.elapsed_ms(start))
+                if rows or not tracked.template_rejected:
+                    raise
+            else:
+                # Includes time spent spilling, since the cursor is paced by it
+                tracked = generated.model_copy(update={"results": []})
+                agent.track_execution(tracked, sql, query_log.elapsed_ms(start), row_count=rows)
+                if not (tracked.template_hit and tracked.template_rejected):
+                    return
+            current = tracked
+    return run
+
+
+def workflow_job(load: Callable[[str], Dict], workflow) -> Callable[[Job], Iterator[List[Dict]]]:
+    """
+    Job body for the CSV and Excel agents. `load` reads the uploaded file from the
+    job directory and returns the initial workflow state; the results are spilled
+    in batches of JOB_BATCH_ROWS.
+    """
+    def run(job: Job):
+        result = workflow.invoke(load(job.dir))
+        results = result["results"]
+        if results and "error" in results[0]:
+            raise RuntimeError(results[0]["error"])
+        for i in range(0, len(results), JOB_BATCH_ROWS):
+            yield results[i:i + JOB_BATCH_ROWS]
+    return run
+
+
+job_manager = JobManager()
@@ -1,34 +1,145 @@
-from fastapi import FastAPI, UploadFile, File, Form, Body
+from fastapi import FastAPI, UploadFile, File, Form, Body, Request, Query
+from fastapi.concurrency import run_in_threadpool
+import anyio
+import functools
 from pydantic import BaseModel
+from typing import Optional
 from fastapi.responses import StreamingResponse, JSONResponse
 import pandas as pd
 import io
 import os
 import json
+import math
+import itertools
 
 from db_postgres import PostgresQueryAgent
 from mysql_module import MySQLQueryAgent
-from csv_module import CSVQueryAgent
-from excel_module import ExcelQueryAgent
-from utils import get_csv_schema, get_excel_schema
+from csv_module import CSVQueryAgent, AgentState as CSVState
+from excel_module import ExcelQueryAgent, AgentState as ExcelState
+from utils import get_csv_schema, get_excel_schema, clean_select
+from scheduler import client_context, QueueFullError, WORKER_THREADS
+from query_templates import template_store
+from jobs import job_manager, sql_job, workflow_job, SUCCEEDED
+from approximate import progressive_execute
+from db_postgres import AgentState as PostgresState
+from mysql_module import AgentState as MySQLState
 
 class UserInput(BaseModel):
     user_input: str
 
 app = FastAPI()
 
+# Scheduled work runs on its own threads, so requests waiting for admission never
+# exhaust the shared threadpool used for uploads and streaming responses.
+worker_slots = anyio.CapacityLimiter(WORKER_THREADS)
+worker_threads = anyio.CapacityLimiter(WORKER_THREADS)
+
 app_graph = PostgresQueryAgent().get_workflow()
 csv_app_graph = CSVQueryAgent().get_workflow()
 excel_app_graph = ExcelQueryAgent().get_workflow()
 mysql_app_graph = MySQLQueryAgent().get_workflow()
 
 
+def client_id_of(request: Request) -> str:
+    return request.headers.get("X-Client-Id") or (request.client.host if request.client else "anonymous")
+
+
+def run_as_client(fn, arg, request: Request):
+    """
+    Calls fn(arg) on behalf of the requesting client so the scheduler can
+    apply per-client fairness and priority (X-Client-Id / X-Priority headers).
+    """
+    priority = request.headers.get("X-Priority", "interactive").lower()
+    with client_context(client_id_of(request), priority):
+        return fn(arg)
+
+
+async def run_scheduled(fn, arg, request: Request):
+    """
+    Runs fn(arg) for the requesting client on a worker thread. When every worker
+    thread is taken the request is rejected with QueueFullError right away instead
+    of waiting, without a timeout, for a thread.
+    """
+    try:
+        worker_slots.acquire_nowait()
+    except anyio.WouldBlock:
+        raise QueueFullError("worker", 1.0)
+    try:
+        return await anyio.to_thread.run_sync(functools.partial(run_as_client, fn, arg, request),
+                                              limiter=worker_threads)
+    finally:
+        worker_slots.release()
+
+
+async def run_workflow(workflow, state: dict, request: Request):
+    return await run_scheduled(workflow.invoke, state, request)
+
+
+def wants_csv_stream(request: Request) -> bool:
+    """Clients that explicitly accept text/csv get the bulk export fast path."""
+    return "text/csv" in request.headers.get("Accept", "")
+
+
+async def export_csv(agent, state, stream_csv, request: Request):
+    """
+    Generates the SQL and, if it is a single read-only SELECT, streams its result
+    as CSV straight from the database via `stream_csv`. Otherwise executes it the
+    regular way. Returns (response, state); response is None when the caller
+    should build the regular response from state.results.
+    """
+    state = await run_scheduled(agent.generate_sql, state, request)
+    if state.results or clean_select(state.sql_query) is None:
+        if not state.results:
+            state = await run_scheduled(agent.execute_query, state, request)
+        return None, state
+    chunks = stream_csv(state)
+    # Pull the first chunk here so SQL and connection errors still become error responses
+    first = await run_scheduled(lambda it: next(it, b""), chunks, request)
+    return StreamingResponse(
+        itertools.chain([first], chunks),
+        media_type="text/csv",
+        headers={"Content-Disposition": "attachment; filename=results.csv"}
+    ), state
+
+
+async def approximate_response(generate, execute, state, data_field: str, time_budget: float,
+                               stratify_by: Optional[str], request: Request):
+    """
+    Generates the pandas code once, then streams progressively refined estimates
+    computed on growing samples of the uploaded data as newline-delimited JSON.
+    Each line reports the estimate, its error bounds, the sample size and the
+    elapsed time; the last line is exact unless the time budget ran out.
+    """
+    state = await run_scheduled(generate, state, request)
+    if state.results and "error" in state.results[0]:
+        return JSONResponse(status_code=500, content=state.results[0])
+
+    def run(sample):
+        return execute(state.model_copy(update={data_field: sample})).results
+
+    def stream():
+        for step in progressive_execute(run, getattr(state, data_field), time_budget, stratify_by):
+            yield json.dumps(step, default=str) + "\n"
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+def queue_full_response(e: QueueFullError):
+    retry_after = int(math.ceil(e.retry_after))
+    return JSONResponse(
+        status_code=429,
+        headers={"Retry-After": str(retry_after)},
+        content={"error": str(e), "retry_after": retry_after}
+    )
+
+
 
 @app.post("/ask_postgres")
-async def ask_postgres(payload: UserInput):
+async def ask_postgres(payload: UserInput, request: Request):
     """
     Accepts a user query for the PostgreSQL database, runs the query using the Postgres agent,
-    and returns the results as a CSV file.
+    and returns the results as a CSV file. With "Accept: text/csv" the CSV is produced by
+    the server with COPY and streamed as-is (an empty result is a header-only file).
     """
     try:
         user_input = payload.user_input
@@ -39,9 +150,15 @@ async def ask_postgres(payload: UserInput):
                 content={"warning": "No database URL provided. Please upload a CSV or Excel file using /ask_csv or /ask_excel endpoint."}
             )
 
-        # Run the Postgres agent workflow
-        workflow = agent.get_workflow()
-        result = workflow.invoke({"user_input": user_input})
+        if wants_csv_stream(request):
+            response, state = await export_csv(agent, PostgresState(user_input=user_input), agent.copy_csv, request)
+            if response is not None:
+                return response
+            result = {"results": state.results}
+        else:
+            # Run the Postgres agent workflow
+            workflow = agent.get_workflow()
+            result = await run_workflow(workflow, {"user_input": user_input}, request)
 
         # Prepare the result DataFrame
         df_result = pd.DataFrame(result["results"])
@@ -60,6 +177,8 @@ async def ask_postgres(payload: UserInput):
             media_type="text/csv",
             headers={"Content-Disposition": "attachment; filename=results.csv"}
         )
+    except QueueFullError as e:
+        return queue_full_response(e)
     except Exception as e:
         return JSONResponse(
             status_code=500,
@@ -69,10 +188,13 @@ async def ask_postgres(payload: UserInput):
 
 
 @app.post("/ask_csv")
-async def ask_csv(user_input: str = Form(...), file: UploadFile = File(...)):
+async def ask_csv(request: Request, user_input: str = Form(...), file: UploadFile = File(...),
+                  approximate: bool = Form(False), time_budget: float = Form(30.0),
+                  stratify_by: Optional[str] = Form(None)):
     """
     Accepts a user query and a CSV file upload, dynamically generates the schema,
     runs the query using the CSV agent, and returns the results as a CSV file.
+    With approximate=true, streams progressively refined estimates on samples instead.
     """
     try:
         # Parse user_input as JSON and extract the actual query string
@@ -97,12 +219,18 @@ async def ask_csv(user_input: str = Form(...), file: UploadFile = File(...)):
         # Dynamically generate the schema string from the DataFrame
         schema = get_csv_schema(df)
 
+        if approximate:
+            agent = CSVQueryAgent()
+            state = CSVState(user_input=user_input_value, csv_schema=schema, df=df)
+            return await approximate_response(agent.generate_pandas_code, agent.run_pandas_code,
+                                              state, "df", time_budget, stratify_by, request)
+
         # Run the CSV agent workflow
-        result = csv_app_graph.invoke({
+        result = await run_workflow(csv_app_graph, {
             "user_input": user_input_value,
             "csv_schema": schema,
             "df": df
-        })
+        }, request)
 
         # Prepare the result DataFrame
         df_result = pd.DataFrame(result["results"])
@@ -121,6 +249,8 @@ async def ask_csv(user_input: str = Form(...), file: UploadFile = File(...)):
             media_type="text/csv",
             headers={"Content-Disposition": "attachment; filename=results.csv"}
         )
+    except QueueFullError as e:
+        return queue_full_response(e)
     except Exception as e:
         return JSONResponse(
             status_code=500,
@@ -133,10 +263,13 @@ async def ask_csv(user_input: str = Form(...), file: UploadFile = File(...)):
 
 
 @app.post("/ask_excel")
-async def ask_excel(user_input: str = Form(...), file: UploadFile = File(...)):
+async def ask_excel(request: Request, user_input: str = Form(...), file: UploadFile = File(...),
+                    approximate: bool = Form(False), time_budget: float = Form(30.0),
+                    stratify_by: Optional[str] = Form(None)):
     """
     Accepts a user query and an Excel file upload, dynamically generates the schema,
     runs the query using the Excel agent, and returns the results as a CSV file.
+    With approximate=true, streams progressively refined estimates on samples instead.
     """
     try:
         # Parse user_input as JSON and extract the actual query string
@@ -163,12 +296,18 @@ async def ask_excel(user_input: str = Form(...), file: UploadFile = File(...)):
         # Dynamically generate the schema string from the sheets
         schema = get_excel_schema(sheets)
 
+        if approximate:
+            agent = ExcelQueryAgent()
+            state = ExcelState(user_input=user_input_value, excel_schema=schema, sheets=sheets)
+            return await approximate_response(agent.generate_excel_code, agent.run_excel_code,
+                                              state, "sheets", time_budget, stratify_by, request)
+
         # Run the Excel agent workflow
-        result = excel_app_graph.invoke({
+        result = await run_workflow(excel_app_graph, {
             "user_input": user_input_value,
             "excel_schema": schema,
             "sheets": sheets
-        })
+        }, request)
 
         # Prepare the result DataFrame
         df_result = pd.DataFrame(result["results"])
@@ -187,6 +326,8 @@ async def ask_excel(user_input: str = Form(...), file: UploadFile = File(...)):
             media_type="text/csv",
             headers={"Content-Disposition": "attachment; filename=results.csv"}
         )
+    except QueueFullError as e:
+        return queue_full_response(e)
     except Exception as e:
         return JSONResponse(
             status_code=500,
@@ -197,10 +338,11 @@ async def ask_excel(user_input: str = Form(...), file: UploadFile = File(...)):
 
 
 @app.post("/ask_mysql")
-async def ask_mysql(payload: UserInput):
+async def ask_mysql(payload: UserInput, request: Request):
     """
     Accepts a user query for the MySQL database, runs the query using the MySQL agent,
-    and returns the results as a CSV file.
+    and returns the results as a CSV file. With "Accept: text/csv" rows are fetched as
+    tuples and streamed in CSV batches (an empty result is a header-only file).
     """
     try:
         user_input = payload.user_input
@@ -212,9 +354,15 @@ async def ask_mysql(payload: UserInput):
                 content={"warning": "No MySQL URL provided. Please set MYSQL_URL in your .env file."}
             )
 
-        # Run the MySQL agent workflow
-        workflow = agent.get_workflow()
-        result = workflow.invoke({"user_input": user_input})
+        if wants_csv_stream(request):
+            response, state = await export_csv(agent, MySQLState(user_input=user_input), agent.iter_csv, request)
+            if response is not None:
+                return response
+            result = {"results": state.results}
+        else:
+            # Run the MySQL agent workflow
+            workflow = agent.get_workflow()
+            result = await run_workflow(workflow, {"user_input": user_input}, request)
 
         # Prepare the result DataFrame
         df_result = pd.DataFrame(result["results"])
@@ -233,8 +381,173 @@ async def ask_mysql(payload: UserInput):
             media_type="text/csv",
             headers={"Content-Disposition": "attachment; filename=results.csv"}
         )
+    except QueueFullError as e:
+        return queue_full_response(e)
     except Exception as e:
         return JSONResponse(
             status_code=500,
             content={"error": f"Internal server error: {str(e)}"}
-        )
\ No newline at end of file
+        )
+
+
+
+@app.get("/template_stats")
+async def template_stats():
+    """
+    Reports how often questions were answered from learned query templates
+    instead of the LLM, and the generation time saved.
+    """
+    return JSONResponse(status_code=200, content=template_store.stats())
+
+
+
+def parse_form_input(user_input: str) -> str:
+    """Extracts the query string from the JSON-encoded user_input form field, or "" if it is malformed."""
+    try:
+        return json.loads(user_input).get("user_input", "")
+    except (ValueError, AttributeError):
+        return ""
+
+
+def job_submitted(job):
+    return JSONResponse(status_code=202, content={"job_id": job.id, "status": job.status})
+
+
+def job_not_found(job_id: str):
+    return JSONResponse(status_code=404, content={"error": f"Job '{job_id}' not found or expired."})
+
+
+@app.post("/jobs/ask_postgres")
+async def submit_postgres_job(payload: UserInput, request: Request):
+    """
+    Submits a PostgreSQL question as a background job and returns its job id
+    immediately. Rows are streamed from the database and spilled to disk.
+    """
+    agent = PostgresQueryAgent()
+    if not agent.db_config:
+        return JSONResponse(
+            status_code=400,
+            content={"warning": "No database URL provided. Please upload a CSV or Excel file using /jobs/ask_csv or /jobs/ask_excel endpoint."}
+        )
+    state = PostgresState(user_input=payload.user_input)
+    job = await run_in_threadpool(job_manager.submit, "postgres", payload.user_input, client_id_of(request),
+                                  sql_job(agent, state))
+    return job_submitted(job)
+
+
+@app.post("/jobs/ask_mysql")
+async def submit_mysql_job(payload: UserInput, request: Request):
+    """
+    Submits a MySQL question as a background job and returns its job id
+    immediately. Rows are streamed from the database and spilled to disk.
+    """
+    agent = MySQLQueryAgent()
+    if not agent.db_config:
+        return JSONResponse(
+            status_code=400,
+            content={"warning": "No MySQL URL provided. Please set MYSQL_URL in your .env file."}
+        )
+    state = MySQLState(user_input=payload.user_input)
+    job = await run_in_threadpool(job_manager.submit, "mysql", payload.user_input, client_id_of(request),
+                                  sql_job(agent, state))
+    return job_submitted(job)
+
+
+@app.post("/jobs/ask_csv")
+async def submit_csv_job(request: Request, user_input: str = Form(...), file: UploadFile = File(...)):
+    """
+    Submits a question over an uploaded CSV file as a background job. The file is
+    saved with the job and parsed by the worker, so the request returns immediately.
+    """
+    user_input_value = parse_form_input(user_input)
+    if not user_input_value:
+        return JSONResponse(status_code=400, content={"error": "Missing 'user_input' in request."})
+    if not file.filename.lower().endswith('.csv'):
+        return JSONResponse(status_code=400, content={"error": "Only CSV files are allowed."})
+
+    def load(job_dir: str) -> dict:
+        df = pd.read_csv(os.path.join(job_dir, "upload.csv"))
+        return {"user_input": user_input_value, "csv_schema": get_csv_schema(df), "df": df}
+
+    job = await run_in_threadpool(
+        job_manager.submit, "csv", user_input_value, client_id_of(request),
+        workflow_job(load, csv_app_graph), file.file, "upload.csv"
+    )
+    return job_submitted(job)
+
+
+@app.post("/jobs/ask_excel")
+async def submit_excel_job(request: Request, user_input: str = Form(...), file: UploadFile = File(...)):
+    """
+    Submits a question over an uploaded Excel file as a background job. The file is
+    saved with the job and parsed by the worker, so the request returns immediately.
+    """
+    user_input_value = parse_form_input(user_input)
+    if not user_input_value:
+        return JSONResponse(status_code=400, content={"error": "Missing 'user_input' in request."})
+    filename = file.filename.lower()
+    if not (filename.endswith('.xlsx') or filename.endswith('.xls')):
+        return JSONResponse(status_code=400, content={"error": "Only Excel files (.xlsx, .xls) are allowed."})
+    engine = "openpyxl" if filename.endswith('.xlsx') else "xlrd"
+    upload_name = "upload.xlsx" if filename.endswith('.xlsx') else "upload.xls"
+
+    def load(job_dir: str) -> dict:
+        sheets = pd.read_excel(os.path.join(job_dir, upload_name), sheet_name=None, engine=engine)
+        return {"user_input": user_input_value, "excel_schema": get_excel_schema(sheets), "sheets": sheets}
+
+    job = await run_in_threadpool(
+        job_manager.submit, "excel", user_input_value, client_id_of(request),
+        workflow_job(load, excel_app_graph), file.file, upload_name
+    )
+    return job_submitted(job)
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    """Returns the status of a job and the number of result rows spilled so far."""
+    job = await run_in_threadpool(job_manager.get, job_id)
+    if job is None:
+        return job_not_found(job_id)
+    return JSONResponse(status_code=200, content=job.to_dict())
+
+
+@app.get("/jobs/{job_id}/partial")
+async def job_partial_results(job_id: str, limit: int = Query(100, ge=1, le=10000)):
+    """Returns up to `limit` result rows spilled so far, while the job is still running or after it finished."""
+    job = await run_in_threadpool(job_manager.get, job_id)
+    if job is None:
+        return job_not_found(job_id)
+    rows = await run_in_threadpool(job.head, limit)
+    return JSONResponse(
+        status_code=200,
+        content={**job.to_dict(), "results": json.loads(rows.to_json(orient="records", date_format="iso"))}
+    )
+
+
+@app.get("/jobs/{job_id}/result")
+async def job_result(job_id: str):
+    """Downloads the full result of a finished job as a CSV file, converted part by part from disk."""
+    job = await run_in_threadpool(job_manager.get, job_id)
+    if job is None:
+        return job_not_found(job_id)
+    if job.status != SUCCEEDED:
+        return JSONResponse(status_code=409, content={**job.to_dict(), "error": job.error or "Job has not finished yet."})
+
+    def stream():
+        for i, frame in enumerate(job.iter_frames()):
+            yield frame.to_csv(index=False, header=(i == 0))
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/csv",
+        headers={"Content-Disposition": f"attachment; filename=results-{job.id}.csv"}
+    )
+
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """Cancels a queued or running job, or deletes the stored result of a finished one."""
+    job = await run_in_threadpool(job_manager.cancel, job_id)
+    if job is None:
+        return job_not_found(job_id)
+    return JSONResponse(status_code=200, content=job.to_dict())
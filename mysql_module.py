@@ -2,9 +2,14 @@ from langgraph.graph import StateGraph, END, START
 from pydantic import BaseModel
 from typing import List, Dict, Optional
 import mysql.connector
+import pandas as pd
 import os
+import time
 from urllib.parse import urlparse
-from utils import llm_invoke
+from utils import llm_invoke, clean_select
+from scheduler import admit, QueueFullError
+import query_log
+from query_templates import template_store
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -13,6 +18,13 @@ class AgentState(BaseModel):
     user_input: str
     sql_query: Optional[str] = ""
     results: List[Dict] = []
+    schema_fingerprint: Optional[str] = None
+    generation_ms: Optional[float] = None
+    db_schema: Optional[str] = None
+    sql_params: Optional[Dict] = None
+    template_hit: bool = False
+    # Set when a template hit failed or found no rows; the query is then regenerated by the LLM
+    template_rejected: bool = False
 
     model_config = {"arbitrary_types_allowed": True}
 
@@ -43,27 +55,41 @@ class MySQLQueryAgent:
     def get_schema(self) -> str:
         if not self.db_config:
             raise RuntimeError("MySQL URL not provided. Please upload a CSV or Excel file instead.")
-        conn = self.get_db_conn()
-        cursor = conn.cursor()
-        try:
-            cursor.execute("""
-                SELECT TABLE_NAME, COLUMN_NAME
-                FROM information_schema.COLUMNS
-                WHERE TABLE_SCHEMA = %s
-            """, (self.db_config["database"],))
-            schema = {}
-            for table, column in cursor.fetchall():
-                schema.setdefault(table, []).append(column)
-            schema_lines = ["Tables and columns:"]
-            for table, columns in schema.items():
-                schema_lines.append(f"{table}: {', '.join(columns)}")
-            return "\n".join(schema_lines)
-        finally:
-            cursor.close()
-            conn.close()
+        # Schema lookups open a connection too, so they go through admission control
+        with admit("mysql"):
+            conn = self.get_db_conn()
+            cursor = conn.cursor()
+            try:
+                cursor.execute("""
+                    SELECT TABLE_NAME, COLUMN_NAME
+                    FROM information_schema.COLUMNS
+                    WHERE TABLE_SCHEMA = %s
+                """, (self.db_config["database"],))
+                schema = {}
+                for table, column in cursor.fetchall():
+                    schema.setdefault(table, []).append(column)
+                schema_lines = ["Tables and columns:"]
+                for table, columns in schema.items():
+                    schema_lines.append(f"{table}: {', '.join(columns)}")
+                return "\n".join(schema_lines)
+            finally:
+                cursor.close()
+                conn.close()
 
     def generate_sql(self, state: AgentState) -> AgentState:
         schema = self.get_schema()
+        state.schema_fingerprint = query_log.schema_fingerprint(schema)
+        state.db_schema = schema
+        # Reuse a learned template for questions of a known shape instead of calling the LLM
+        template = None if state.template_rejected else template_store.match("mysql", schema, state.user_input)
+        state.template_hit = False
+        state.sql_params = None
+        state.results = []
+        if template:
+            state.sql_query = template["query"]
+            state.sql_params = template["params"]
+            state.template_hit = True
+            return state
         # Extract table names for prompt clarity
         table_names = []
         for line in schema.splitlines():
@@ -95,12 +121,16 @@ Return ONLY the SQL query, no explanations, no comments, no markdown, no code fe
 Request: '{state.user_input}'
 """
         try:
+            start = time.perf_counter()
             sql_query = llm_invoke(prompt)
+            state.generation_ms = query_log.elapsed_ms(start)
             sql_query = sql_query.strip()
             if sql_query.startswith("```"):
                 sql_query = sql_query.lstrip("`").replace("sql", "", 1).strip().rstrip("`").strip()
             state.sql_query = sql_query
             return state
+        except QueueFullError:
+            raise
         except Exception as e:
             state.results = [{"error": f"SQL generation failed: {str(e)}"}]
             return state
@@ -109,21 +139,144 @@ Request: '{state.user_input}'
         sql = (state.sql_query or "").strip()
         if sql.startswith("```"):
             sql = sql.lstrip("`").replace("sql", "", 1).strip().rstrip("`").strip()
+        execution_ms, plan = None, None
         try:
+            with admit("mysql"):
+                conn = self.get_db_conn()
+                cursor = conn.cursor(dictionary=True)
+                try:
+                    start = time.perf_counter()
+                    cursor.execute(sql, state.sql_params or None)
+                    results = cursor.fetchall()
+                    execution_ms = query_log.elapsed_ms(start)
+                    state.results = results
+                    if query_log.wants_plan(execution_ms):
+                        plan = self.explain(conn, sql, state.sql_params)
+                except Exception as e:
+                    execution_ms = query_log.elapsed_ms(start)
+                    state.results = [{"error": f"SQL execution failed: {str(e)}", "query": sql}]
+                finally:
+                    cursor.close()
+                    conn.close()
+        except QueueFullError:
+            raise
+        except Exception as e:
+            state.results = [{"error": f"Database connection failed: {str(e)}"}]
+        self.track_execution(state, sql, execution_ms, plan)
+        if state.template_hit and state.template_rejected:
+            state = self.generate_sql(state)
+            if not state.results:
+                state = self.execute_query(state)
+        return state
+
+    def track_execution(self, state: AgentState, sql: str, execution_ms: Optional[float],
+                        plan: Optional[str] = None, row_count: Optional[int] = None):
+        """
+        Rejects a template hit that failed (forgetting the template) or found no rows,
+        learns a template from a successful generation and logs slow executions.
+        `row_count` is given for results that were streamed rather than stored in
+        state.results.
+        """
+        failed = bool(state.results) and "error" in state.results[0]
+        if row_count is None:
+            row_count = len(state.results)
+        if state.template_hit and (failed or not row_count):
+            template_store.reject("mysql", state.db_schema, sql)
+            if failed:
+                template_store.forget("mysql", state.db_schema, sql)
+            state.template_rejected = True
+        elif row_count and not failed and not state.template_hit:
+            template_store.learn("mysql", state.db_schema, state.user_input, sql, state.generation_ms)
+        query_log.record("mysql", state.user_input, state.schema_fingerprint, sql, state.generation_ms,
+                         execution_ms, state.results, plan, state.sql_params, row_count)
+
+    def iter_query(self, state: AgentState, batch_size: int = 10000, on_connect=None, on_columns=None):
+        """
+        Executes the generated SQL with an unbuffered cursor and yields the rows in
+        batches, so large results never have to be held in memory at once.
+        `on_connect` is called with the open connection, e.g. to allow cancelling,
+        and `on_columns` with the result column names once the query has run.
+        """
+        sql = (state.sql_query or "").strip()
+        if sql.startswith("```"):
+            sql = sql.lstrip("`").replace("sql", "", 1).strip().rstrip("`").strip()
+        with admit("mysql"):
             conn = self.get_db_conn()
+            if on_connect:
+                on_connect(conn)
             cursor = conn.cursor(dictionary=True)
             try:
-                cursor.execute(sql)
-                results = cursor.fetchall()
-                state.results = results
-            except Exception as e:
-                state.results = [{"error": f"SQL execution failed: {str(e)}", "query": sql}]
+                cursor.execute(sql, state.sql_params or None)
+                rows = cursor.fetchmany(batch_size)
+                if on_columns and cursor.description:
+                    on_columns([d[0] for d in cursor.description])
+                while rows:
+                    yield rows
+                    rows = cursor.fetchmany(batch_size)
             finally:
-                cursor.close()
-                conn.close()
+                try:
+                    cursor.close()
+                finally:
+                    # Closing the connection discards any unread rows of an abandoned stream
+                    conn.close()
+
+    def iter_csv(self, state: AgentState, batch_size: int = 10000):
+        """
+        Streams the result of the generated SELECT as UTF-8 CSV. Rows are fetched
+        as plain tuples rather than one dict per row, and each batch is encoded
+        column-wise by pandas instead of row by row. Like execute_query, the
+        execution is logged and updates the template store once the stream ends.
+        """
+        sql = clean_select(state.sql_query)
+        if sql is None:
+            raise ValueError("Only a single SELECT statement can be exported as CSV.")
+        with admit("mysql"):
+            conn = self.get_db_conn()
+            cursor = conn.cursor()
+            start, row_count = time.perf_counter(), 0
+            try:
+                try:
+                    cursor.execute(sql, state.sql_params or None)
+                    columns = [d[0] for d in cursor.description]
+                    header = True
+                    while True:
+                        rows = cursor.fetchmany(batch_size)
+                        if not rows:
+                            break
+                        row_count += len(rows)
+                        frame = pd.DataFrame.from_records(rows, columns=columns)
+                        yield frame.to_csv(index=False, header=header).encode("utf-8")
+                        header = False
+                    if header:
+                        yield pd.DataFrame(columns=columns).to_csv(index=False).encode("utf-8")
+                except Exception as e:
+                    failed = state.model_copy(update={"results": [{"error": f"SQL execution failed: {str(e)}", "query": sql}]})
+                    self.track_execution(failed, sql, query_log.elapsed_ms(start))
+                    raise
+                # Includes time spent waiting on the client, since fetching is paced by it
+                self.track_execution(state.model_copy(update={"results": []}), sql, query_log.elapsed_ms(start),
+                                     row_count=row_count)
+            finally:
+                try:
+                    cursor.close()
+                finally:
+                    conn.close()
+
+    def explain(self, conn, sql: str, params: Optional[Dict] = None) -> str:
+        """
+        Returns the EXPLAIN ANALYZE output for sql. The statement is run inside a
+        transaction that is rolled back, so it has no lasting side effects.
+        """
+        cursor = conn.cursor()
+        try:
+            conn.rollback()
+            cursor.execute(f"EXPLAIN ANALYZE {sql}", params or None)
+            return "\n".join(str(row[0]) for row in cursor.fetchall())
         except Exception as e:
-            state.results = [{"error": f"Database connection failed: {str(e)}"}]
-        return state
+            return f"EXPLAIN failed: {str(e)}"
+        finally:
+            cursor.close()
+            conn.rollback()
 
     def get_workflow(self):
         """Define the workflow for the agent."""
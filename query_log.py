@@ -0,0 +1,188 @@
+import argparse
+import difflib
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+from dotenv import load_dotenv
+
+load_dotenv()
+
+SLOW_QUERY_LOG_PATH = os.getenv("SLOW_QUERY_LOG_PATH", "slow_queries.jsonl")
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv("SLOW_QUERY_THRESHOLD_MS", 1000))
+SLOW_QUERY_EXPLAIN = os.getenv("SLOW_QUERY_EXPLAIN", "false").lower() in ("1", "true", "yes")
+
+# Disabled while replaying so re-runs do not append to the log being replayed.
+enabled = True
+_lock = threading.Lock()
+
+
+def schema_fingerprint(schema: str) -> str:
+    return hashlib.sha256((schema or "").encode("utf-8")).hexdigest()[:16]
+
+
+def elapsed_ms(start: float) -> float:
+    return round((time.perf_counter() - start) * 1000, 2)
+
+
+def wants_plan(execution_ms: Optional[float]) -> bool:
+    """Whether an execution is slow enough to capture its plan."""
+    return SLOW_QUERY_EXPLAIN and execution_ms is not None and execution_ms >= SLOW_QUERY_THRESHOLD_MS
+
+
+def record(backend: str, question: str, fingerprint: Optional[str], generated: Optional[str],
+           generation_ms: Optional[float], execution_ms: Optional[float], results: List[Dict],
+           plan: Optional[str] = None, params: Optional[Dict] = None, row_count: Optional[int] = None,
+           touched_columns: Optional[List[str]] = None):
+    """
+    Appends an entry to the slow-query log if generation or execution took
+    longer than SLOW_QUERY_THRESHOLD_MS. `row_count` overrides len(results) for
+    results that were streamed rather than collected. `touched_columns` are the
+    columns pandas code was found to read (None if unknown). Never raises.
+    """
+    if not enabled:
+        return
+    timings = [t for t in (generation_ms, execution_ms) if t is not None]
+    if not timings or max(timings) < SLOW_QUERY_THRESHOLD_MS:
+        return
+    error = results[0].get("error") if results and isinstance(results[0], dict) else None
+    entry = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "backend": backend,
+        "question": question,
+        "schema_fingerprint": fingerprint,
+        "generated": generated,
+        "params": params,
+        "generation_ms": generation_ms,
+        "execution_ms": execution_ms,
+        "row_count": None if error else (len(results) if row_count is None else row_count),
+        "error": error,
+        "plan": plan,
+        "touched_columns": touched_columns,
+    }
+    try:
+        with _lock, open(SLOW_QUERY_LOG_PATH, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, default=str) + "\n")
+    except Exception:
+        pass
+
+
+def load_entries(path: str) -> List[Dict]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def replay_entry(entry: Dict, data_path: Optional[str] = None, explain: bool = False,
+                 db_url: Optional[str] = None) -> Dict:
+    """
+    Re-runs a logged SQL query or pandas snippet with the current code against
+    the configured database (DB_URL / MYSQL_URL, or `db_url`) or a local copy of
+    the dataset.
+    """
+    import pandas as pd
+    from utils import get_csv_schema, get_excel_schema
+
+    backend = entry["backend"]
+    replay = {"execution_ms": None, "row_count": None, "error": None, "plan": None, "schema_fingerprint": None}
+    if backend in ("postgres", "mysql"):
+        if backend == "postgres":
+            from db_postgres import PostgresQueryAgent as Agent, AgentState
+        else:
+            from mysql_module import MySQLQueryAgent as Agent, AgentState
+        if db_url:
+            # Set after the agent module is imported: importing utils reloads .env with override=True
+            os.environ["DB_URL" if backend == "postgres" else "MYSQL_URL"] = db_url
+        agent = Agent()
+        replay["schema_fingerprint"] = schema_fingerprint(agent.get_schema())
+        state = AgentState(user_input=entry["question"], sql_query=entry["generated"], sql_params=entry.get("params"))
+        start = time.perf_counter()
+        state = agent.execute_query(state)
+        replay["execution_ms"] = elapsed_ms(start)
+        if explain:
+            conn = agent.get_db_conn()
+            try:
+                replay["plan"] = agent.explain(conn, entry["generated"], entry.get("params"))
+            finally:
+                conn.close()
+    elif backend in ("csv", "excel"):
+        if not data_path:
+            raise ValueError(f"Replaying a {backend} entry requires --data pointing to a copy of the dataset.")
+        if backend == "csv":
+            from csv_module import CSVQueryAgent, AgentState
+            df = pd.read_csv(data_path)
+            schema = get_csv_schema(df)
+            state = AgentState(user_input=entry["question"], sql_query=entry["generated"], csv_schema=schema, df=df,
+                               sql_params=entry.get("params"))
+            run = CSVQueryAgent().execute_pandas_code
+        else:
+            from excel_module import ExcelQueryAgent, AgentState
+            sheets = pd.read_excel(data_path, sheet_name=None)
+            schema = get_excel_schema(sheets)
+            state = AgentState(user_input=entry["question"], sql_query=entry["generated"], excel_schema=schema,
+                               sheets=sheets, sql_params=entry.get("params"))
+            run = ExcelQueryAgent().execute_excel_code
+        replay["schema_fingerprint"] = schema_fingerprint(schema)
+        start = time.perf_counter()
+        state = run(state)
+        replay["execution_ms"] = elapsed_ms(start)
+    else:
+        raise ValueError(f"Unknown backend '{backend}' in log entry.")
+    results = state.results
+    replay["error"] = results[0].get("error") if results and isinstance(results[0], dict) else None
+    replay["row_count"] = None if replay["error"] else len(results)
+    return replay
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay slow-query log entries and compare timings and plans.")
+    parser.add_argument("--log", default=SLOW_QUERY_LOG_PATH, help="Path to the slow-query log (JSON lines).")
+    parser.add_argument("--backend", choices=["postgres", "mysql", "csv", "excel"], help="Only replay this backend.")
+    parser.add_argument("--data", help="Local copy of the CSV/Excel dataset for csv/excel entries.")
+    parser.add_argument("--db-url", help="Override DB_URL (postgres) or MYSQL_URL (mysql); requires --backend.")
+    parser.add_argument("--limit", type=int, help="Replay at most this many entries.")
+    parser.add_argument("--explain", action="store_true", help="Capture plans and diff them against the logged ones.")
+    args = parser.parse_args(argv)
+    if args.db_url and args.backend not in ("postgres", "mysql"):
+        parser.error("--db-url requires --backend postgres or --backend mysql")
+
+    # Run as a script this file is __main__; the agents import it as query_log
+    import query_log
+    from query_templates import template_store
+
+    query_log.enabled = False
+    template_store.enabled = False
+    entries = load_entries(args.log)
+    if args.backend:
+        entries = [e for e in entries if e["backend"] == args.backend]
+    if args.limit:
+        entries = entries[:args.limit]
+
+    for i, entry in enumerate(entries, 1):
+        try:
+            replay = replay_entry(entry, args.data, args.explain, args.db_url)
+        except Exception as e:
+            print(f"[{i}] {entry['backend']} {entry['timestamp']}: replay failed: {e}")
+            continue
+        before, after = entry.get("execution_ms"), replay["execution_ms"]
+        ratio = f"{after / before:.2f}x" if before and after else "n/a"
+        print(f"[{i}] {entry['backend']} {entry['timestamp']}: {before} ms -> {after} ms ({ratio}), "
+              f"rows {entry.get('row_count')} -> {replay['row_count']}")
+        print(f"    question: {entry['question']}")
+        if replay["schema_fingerprint"] != entry.get("schema_fingerprint"):
+            print("    schema changed since this entry was logged")
+        if replay["error"]:
+            print(f"    error: {replay['error']}")
+        if args.explain and entry.get("plan") and replay["plan"]:
+            diff = difflib.unified_diff(entry["plan"].splitlines(), replay["plan"].splitlines(),
+                                        "logged plan", "replayed plan", lineterm="")
+            for line in diff:
+                print(f"    {line}")
+        elif args.explain and replay["plan"]:
+            print("    " + replay["plan"].replace("\n", "\n    "))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,448 @@
+import ast
+import difflib
+import json
+import os
+import re
+import threading
+import time
+from typing import Dict, List, Optional
+from dotenv import load_dotenv
+from query_log import schema_fingerprint
+
+load_dotenv()
+
+TEMPLATE_STORE_PATH = os.getenv("TEMPLATE_STORE_PATH", "query_templates.json")
+TEMPLATE_STORE_MAX = int(os.getenv("TEMPLATE_STORE_MAX", 1000))
+# Minimum trigram similarity for a stored template to be considered at all.
+TEMPLATE_MIN_SIMILARITY = float(os.getenv("TEMPLATE_MIN_SIMILARITY", 0.5))
+
+SQL_BACKENDS = ("postgres", "mysql")
+PANDAS_BACKENDS = ("csv", "excel")
+
+QUESTION_TOKEN = re.compile(r"'[^']*'|\"[^\"]*\"|\d+(?:\.\d+)?|\w+|[^\w\s]")
+SQL_TOKEN = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"]|\"\")*\"|`[^`]*`|[A-Za-z_][\w$]*|\d+(?:\.\d+)?|\s+|.", re.S)
+SLOT = re.compile(r"<slot(\d+):(number|string)>")
+PLACEHOLDER = re.compile(r"%\(\w+\)s")
+# Words that may differ between two phrasings of the same question. Any other
+# differing word means a different question, so the template is not used.
+IGNORABLE_WORDS = {"please", "show", "me", "list", "give", "get", "find", "what", "is", "are",
+                   "the", "a", "an", "tell"}
+# Words that qualify a question rather than name a value, so an unquoted
+# string slot never takes them ("how many total customers" is not status 'total').
+QUANTIFIER_WORDS = {"all", "any", "each", "every", "some", "total", "overall", "many", "much", "more",
+                    "most", "less", "least", "fewer", "other", "no", "none", "both", "several",
+                    "number", "count", "sum", "average"}
+# How a string literal's case relates to the question text it was taken from,
+# e.g. 'London' for "london" is title. Applied to values bound from new questions.
+CASE_TRANSFORMS = {"as_is": lambda s: s, "lower": str.lower, "upper": str.upper, "title": str.title}
+
+
+def _tokenize(question: str) -> List[Dict]:
+    """Word, number and quoted-string tokens of a question with their character spans; punctuation is dropped."""
+    tokens = []
+    for m in QUESTION_TOKEN.finditer(question):
+        text = m.group()
+        if text[0] in "'\"":
+            kind, norm = "quoted", text[1:-1].lower()
+        elif text[0].isdigit():
+            kind, norm = "number", text
+        elif re.match(r"\w", text):
+            kind, norm = "word", text.lower()
+        else:
+            continue
+        tokens.append({"norm": norm, "kind": kind, "start": m.start(), "end": m.end()})
+    return tokens
+
+
+def _trigrams(text: str) -> set:
+    text = f"  {text} "
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _is_number(text: str) -> bool:
+    return re.fullmatch(r"\d+(?:\.\d+)?", text) is not None
+
+
+def _case_of(original: str, literal: str) -> Optional[str]:
+    """The CASE_TRANSFORMS entry turning `original` into `literal`, or None if none does."""
+    for name, transform in CASE_TRANSFORMS.items():
+        if transform(original) == literal:
+            return name
+    return None
+
+
+class _Aligner:
+    """
+    Maps literals of a generated query onto spans of the question. Each distinct
+    span becomes a slot; a literal may wrap its slot in a fixed prefix/suffix
+    (e.g. LIKE '%bob%' or '2024-01-01' for "2024").
+    """
+
+    def __init__(self, question: str, schema: str = ""):
+        self.question = question
+        self.tokens = _tokenize(question)
+        self.slots = []  # (first token index, last token index + 1)
+        # Table and column names are query structure, never parameters
+        self.reserved = set(re.findall(r"\w+", schema.lower()))
+        self.unaligned = []
+        # Set when a literal matches several places in the question; such queries are not learned
+        self.ambiguous = False
+        # Set when a literal's case cannot be derived from the question (e.g. 'McDonald' for
+        # "mcdonald"); other values could not be bound the same way, so it is not learned either
+        self.uncased = False
+
+    def _span_text(self, i: int, j: int) -> str:
+        return self._original_text(i, j).lower()
+
+    def _original_text(self, i: int, j: int) -> str:
+        """Question text of tokens i..j-1 as typed, without the quotes of a quoted string."""
+        if j - i == 1 and self.tokens[i]["kind"] == "quoted":
+            return self.question[self.tokens[i]["start"] + 1:self.tokens[i]["end"] - 1]
+        return self.question[self.tokens[i]["start"]:self.tokens[j - 1]["end"]]
+
+    def _candidates(self, literal: str, is_number: bool) -> List[tuple]:
+        """All (start, end, prefix, suffix) spans of the question the literal may come from, best matches only."""
+        tokens = self.tokens
+        if is_number:
+            return [(i, i + 1, "", "") for i, t in enumerate(tokens)
+                    if t["kind"] == "number" and float(t["norm"]) == float(literal)]
+        lowered = literal.lower()
+        lit_tokens = [t["norm"] for t in _tokenize(literal)]
+        found = []
+        for i, t in enumerate(tokens):
+            if t["kind"] == "quoted" and t["norm"] == lowered:
+                found.append((i, i + 1, "", ""))
+            elif lit_tokens and [x["norm"] for x in tokens[i:i + len(lit_tokens)]] == lit_tokens \
+                    and self._span_text(i, i + len(lit_tokens)) == lowered:
+                found.append((i, i + len(lit_tokens), "", ""))
+        if found:
+            return found
+        for width in range(min(4, len(tokens)), 0, -1):
+            for i in range(len(tokens) - width + 1):
+                text = self._span_text(i, i + width)
+                pos = lowered.find(text)
+                if pos < 0 or not (any(c.isdigit() for c in text) or len(text) >= 3):
+                    continue
+                prefix, suffix = literal[:pos], literal[pos + len(text):]
+                if not re.search(r"[A-Za-z]", prefix + suffix):
+                    found.append((i, i + width, prefix, suffix))
+            if found:
+                return found
+        return []
+
+    def align(self, literal: str, is_number: bool) -> Optional[Dict]:
+        """Returns a parameter spec for the literal, or None if it is not taken from the question."""
+        found = [] if literal.lower() in self.reserved else self._candidates(literal, is_number)
+        if not found:
+            self.unaligned.append((literal, is_number))
+            return None
+        if len({(i, j) for i, j, _, _ in found}) > 1:
+            # e.g. "top 5 customers with more than 5 orders": which 5 is which is unknown
+            self.ambiguous = True
+            return None
+        i, j, prefix, suffix = found[0]
+        if (i, j) not in self.slots:
+            if any(i < b and a < j for a, b in self.slots):
+                self.unaligned.append((literal, is_number))
+                return None
+            self.slots.append((i, j))
+        kind = "number" if is_number else "string"
+        case = None
+        if not is_number:
+            case = _case_of(self._original_text(i, j), literal[len(prefix):len(literal) - len(suffix)])
+            if case is None:
+                self.uncased = True
+                return None
+        return {"slot": (i, j), "prefix": prefix, "suffix": suffix, "kind": kind,
+                "float": is_number and "." in literal, "case": case}
+
+    def derives_from_numbers(self) -> bool:
+        """
+        True if a literal left in the query looks computed from a number in a
+        slot, e.g. '2025-01-01' or 2025 from "in 2024". Such a literal would go
+        stale when the slot is rebound.
+        """
+        numbers = [float(t["norm"]) for a, b in self.slots for t in self.tokens[a:b] if t["kind"] == "number"]
+        if not numbers:
+            return False
+        for literal, is_number in self.unaligned:
+            if is_number and any(abs(float(literal) - n) <= 1 for n in numbers):
+                return True
+            if not is_number and re.search(r"\d", literal):
+                return True
+        return False
+
+    def slot_specs(self) -> List[Dict]:
+        """Token width of each slot, and whether it was a quoted string, in slot order."""
+        return [{"width": b - a, "quoted": b - a == 1 and self.tokens[a]["kind"] == "quoted"}
+                for a, b in sorted(self.slots)]
+
+    def shape(self, params: List[Dict]) -> List[str]:
+        """Question tokens with every slot span replaced by a <slotN:kind> marker."""
+        order = sorted(self.slots)
+        for p in params:
+            p["slot"] = order.index(p["slot"])
+        out, k = [], 0
+        while k < len(self.tokens):
+            span = next(((a, b) for a, b in order if a == k), None)
+            if span is None:
+                out.append(self.tokens[k]["norm"])
+                k += 1
+                continue
+            a, b = span
+            kind = "number" if b - a == 1 and self.tokens[a]["kind"] == "number" else "string"
+            out.append(f"<slot{order.index(span)}:{kind}>")
+            k = b
+        return out
+
+
+def _parameterize_sql(sql: str, aligner: _Aligner, backend: str):
+    """
+    Replaces question-derived literals with %(pN)s placeholders. Other % signs
+    are escaped as %% for psycopg2, which unescapes them. mysql-connector only
+    substitutes %(name)s and passes %% through, so they stay as they are there.
+    """
+    out, params = [], []
+    for tok in SQL_TOKEN.findall(sql):
+        param = None
+        if tok.startswith("'") and "\\" not in tok:
+            param = aligner.align(tok[1:-1].replace("''", "'"), False)
+        elif _is_number(tok):
+            param = aligner.align(tok, True)
+        if param is None:
+            if backend == "mysql" and PLACEHOLDER.search(tok):
+                raise ValueError("query text looks like a placeholder")
+            out.append(tok if backend == "mysql" else tok.replace("%", "%%"))
+        else:
+            param["name"] = f"p{len(params)}"
+            params.append(param)
+            out.append(f"%({param['name']})s")
+    if not params:
+        # Executed without parameters, so % signs must stay unescaped
+        return sql, params
+    return "".join(out), params
+
+
+def _parameterize_code(code: str, aligner: _Aligner):
+    """
+    Replaces question-derived constants in pandas code with _pN variables. They
+    are passed to exec as globals, so lambdas and comprehensions can read them.
+    """
+    tree = ast.parse(code)
+    skip = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Subscript) and isinstance(node.slice, (ast.Constant, ast.List, ast.Tuple)):
+            # Column selections are structure, not values
+            skip.update(id(n) for n in ast.walk(node.slice))
+        elif isinstance(node, ast.keyword):
+            skip.add(id(node.value))
+        elif isinstance(node, ast.Compare) and isinstance(node.left, ast.Subscript) \
+                and isinstance(node.left.slice, ast.Constant) and node.left.slice.value == "table_name":
+            # Splitting a denormalized CSV by table is structure too
+            skip.update(id(n) for n in node.comparators)
+    params = []
+
+    class Replace(ast.NodeTransformer):
+        def visit_Constant(self, node):
+            if id(node) in skip or isinstance(node.value, bool) or not isinstance(node.value, (str, int, float)):
+                return node
+            param = aligner.align(str(node.value), not isinstance(node.value, str))
+            if param is None:
+                return node
+            param["name"] = f"_p{len(params)}"
+            params.append(param)
+            return ast.Name(id=param["name"], ctx=ast.Load())
+
+    tree = ast.fix_missing_locations(Replace().visit(tree))
+    return ast.unparse(tree), params
+
+
+class TemplateStore:
+    """
+    Learns parameterized templates from successful generations and reuses them
+    for later questions of the same shape, skipping the LLM.
+
+    Parameters are always bound by the database driver (SQL) or passed as
+    variables (pandas code); values from a question are never spliced into
+    query text.
+    """
+
+    def __init__(self, path: str = TEMPLATE_STORE_PATH):
+        self.path = path
+        # Disabled while replaying logged queries so replays neither learn nor forget templates.
+        self.enabled = True
+        self._lock = threading.Lock()
+        self._templates = []
+        self._stats = {"hits": 0, "misses": 0, "learned": 0, "saved_ms": 0.0}
+        if os.path.exists(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    self._templates = json.load(f)
+            except Exception:
+                self._templates = []
+
+    def _save(self):
+        try:
+            tmp = f"{self.path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self._templates, f)
+            os.replace(tmp, self.path)
+        except Exception:
+            pass
+
+    def learn(self, backend: str, schema: str, question: str, query: str,
+              generation_ms: Optional[float] = None):
+        """Stores a template for a query that was generated for `question` and executed successfully."""
+        if not self.enabled:
+            return
+        aligner = _Aligner(question, schema)
+        try:
+            if backend in SQL_BACKENDS:
+                template, params = _parameterize_sql(query, aligner, backend)
+            else:
+                template, params = _parameterize_code(query, aligner)
+        except (SyntaxError, ValueError):
+            return
+        if aligner.ambiguous or aligner.uncased or aligner.derives_from_numbers():
+            return
+        fingerprint = schema_fingerprint(schema)
+        shape = aligner.shape(params)
+        entry = {
+            "backend": backend,
+            "fingerprint": fingerprint,
+            "shape": shape,
+            "query": template,
+            "params": params,
+            "slots": aligner.slot_specs(),
+            "generation_ms": generation_ms or 0.0,
+            "hits": 0,
+            "created": time.time(),
+        }
+        with self._lock:
+            self._templates = [t for t in self._templates
+                               if (t["backend"], t["fingerprint"], t["shape"]) != (backend, fingerprint, shape)]
+            self._templates.append(entry)
+            if len(self._templates) > TEMPLATE_STORE_MAX:
+                self._templates.sort(key=lambda t: (t["hits"], t["created"]))
+                self._templates = self._templates[-TEMPLATE_STORE_MAX:]
+            self._stats["learned"] += 1
+            self._save()
+
+    def _bind(self, template: Dict, question: str, tokens: List[Dict]) -> Optional[Dict]:
+        shape = template["shape"]
+        specs = template.get("slots")
+        if specs is None:
+            return None
+        norms = [t["norm"] for t in tokens]
+        values = {}
+        matcher = difflib.SequenceMatcher(None, shape, norms, autojunk=False)
+        for op, i1, i2, j1, j2 in matcher.get_opcodes():
+            if op == "equal":
+                continue
+            slots = [SLOT.fullmatch(s) for s in shape[i1:i2]]
+            if any(slots):
+                if op != "replace" or i2 - i1 != 1 or j2 <= j1:
+                    return None
+                index, kind = int(slots[0].group(1)), slots[0].group(2)
+                span = tokens[j1:j2]
+                if kind == "number" and (len(span) != 1 or span[0]["kind"] != "number"):
+                    return None
+                # A string slot takes exactly as many tokens as it had when learned, so extra
+                # qualifiers ("alice in 2023", "bob or alice") never end up inside the value
+                if specs[index]["quoted"]:
+                    if len(span) != 1 or span[0]["kind"] != "quoted":
+                        return None
+                    values[index] = question[span[0]["start"] + 1:span[0]["end"] - 1]
+                else:
+                    if len(span) != specs[index]["width"] or any(t["kind"] == "quoted" for t in span):
+                        return None
+                    if any(t["norm"] in IGNORABLE_WORDS or t["norm"] in QUANTIFIER_WORDS for t in span):
+                        return None
+                    values[index] = question[span[0]["start"]:span[-1]["end"]]
+            elif not all(w in IGNORABLE_WORDS for w in shape[i1:i2] + norms[j1:j2]):
+                return None
+        params = {}
+        for p in template["params"]:
+            if p["slot"] not in values:
+                return None
+            value = values[p["slot"]]
+            if p["kind"] == "number":
+                if not _is_number(value):
+                    return None
+                params[p["name"]] = float(value) if p["float"] or "." in value else int(value)
+            else:
+                if p.get("case") not in CASE_TRANSFORMS:
+                    # Learned before case transforms were recorded
+                    return None
+                params[p["name"]] = f"{p['prefix']}{CASE_TRANSFORMS[p['case']](value)}{p['suffix']}"
+        return params
+
+    def match(self, backend: str, schema: str, question: str) -> Optional[Dict]:
+        """
+        Returns {"query", "params", "generation_ms"} for a stored template matching
+        the question, or None. Candidates come from a trigram index over template
+        shapes; a candidate is used only if every difference from the question is
+        a slot value or an ignorable word.
+        """
+        fingerprint = schema_fingerprint(schema)
+        tokens = _tokenize(question)
+        grams = _trigrams(" ".join(t["norm"] for t in tokens))
+        with self._lock:
+            scored = []
+            for t in self._templates:
+                if t["backend"] != backend or t["fingerprint"] != fingerprint:
+                    continue
+                static = _trigrams(" ".join(s for s in t["shape"] if not SLOT.fullmatch(s)))
+                # Share of the template's fixed text found in the question
+                score = len(grams & static) / len(static) if static else 0.0
+                if score >= TEMPLATE_MIN_SIMILARITY:
+                    scored.append((score, t))
+            scored.sort(key=lambda x: -x[0])
+            for _, t in scored[:5]:
+                params = self._bind(t, question, tokens)
+                if params is not None:
+                    t["hits"] += 1
+                    self._stats["hits"] += 1
+                    self._stats["saved_ms"] += t["generation_ms"]
+                    return {"query": t["query"], "params": params, "generation_ms": t["generation_ms"]}
+            self._stats["misses"] += 1
+            return None
+
+    def forget(self, backend: str, schema: str, query: str):
+        """Drops a template whose instantiation failed to execute."""
+        if not self.enabled:
+            return
+        fingerprint = schema_fingerprint(schema)
+        with self._lock:
+            self._templates = [t for t in self._templates
+                               if (t["backend"], t["fingerprint"], t["query"]) != (backend, fingerprint, query)]
+            self._save()
+
+    def reject(self, backend: str, schema: str, query: str):
+        """
+        Counts a template hit whose instantiation failed or returned no rows as a
+        miss; the caller regenerates the query with the LLM instead.
+        """
+        if not self.enabled:
+            return
+        fingerprint = schema_fingerprint(schema)
+        with self._lock:
+            for t in self._templates:
+                if (t["backend"], t["fingerprint"], t["query"]) == (backend, fingerprint, query):
+                    t["hits"] = max(t["hits"] - 1, 0)
+                    self._stats["saved_ms"] -= t["generation_ms"]
+            self._stats["hits"] -= 1
+            self._stats["misses"] += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return {
+                **self._stats,
+                "saved_ms": round(self._stats["saved_ms"], 2),
+                "hit_rate": round(self._stats["hits"] / lookups, 4) if lookups else 0.0,
+                "templates": len(self._templates),
+            }
+
+
+template_store = TemplateStore()
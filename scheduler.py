@@ -0,0 +1,193 @@
+import contextvars
+import itertools
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+load_dotenv()
+
+INTERACTIVE = 0
+BATCH = 1
+PRIORITIES = {"interactive": INTERACTIVE, "batch": BATCH}
+
+# (client_id, priority) of the request currently being served.
+_client = contextvars.ContextVar("scheduler_client", default=("anonymous", INTERACTIVE))
+
+
+class QueueFullError(Exception):
+    """
+    Raised when a backend cannot admit a request, either because its queue is
+    full or because the request waited longer than the queue timeout.
+    """
+
+    def __init__(self, backend: str, retry_after: float):
+        super().__init__(f"The {backend} backend is busy. Please retry after {retry_after:.0f} seconds.")
+        self.backend = backend
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """
+    Token bucket refilled at `rate_per_minute`, holding at most `burst` tokens.
+    Not thread-safe on its own; callers hold the owning backend's lock.
+    """
+
+    def __init__(self, rate_per_minute: float, burst: int):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self, now: float) -> float:
+        """Take one token and return 0, or return the seconds until one is available."""
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def delay_for(self, n: int) -> float:
+        """Seconds until `n` more tokens will have been issued."""
+        self._refill(time.monotonic())
+        return max(0.0, (n - self.tokens) / self.rate)
+
+
+class Backend:
+    """
+    Bounded admission queue for one backend (the LLM or a database).
+
+    At most `max_concurrency` callers run at once and at most `max_queue` wait.
+    Waiters are admitted by priority class first, then by the fewest running
+    requests for the same client, then in arrival order.
+    """
+
+    def __init__(self, name: str, max_concurrency: int, max_queue: int,
+                 timeout: float, rate_per_minute: float = None, burst: int = None):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.bucket = TokenBucket(rate_per_minute, burst or max_concurrency) if rate_per_minute else None
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._waiting = []
+        self._active = 0
+        self._active_by_client = {}
+        self._avg_service = 1.0
+
+    def _next_waiter(self):
+        return min(
+            self._waiting,
+            key=lambda w: (w[0], self._active_by_client.get(w[1], 0), w[2]),
+        )
+
+    def _retry_after(self) -> float:
+        backlog = len(self._waiting) + 1
+        estimate = backlog * self._avg_service / self.max_concurrency
+        if self.bucket:
+            estimate = max(estimate, self.bucket.delay_for(backlog))
+        return max(1.0, estimate)
+
+    def acquire(self, client_id: str, priority: int):
+        with self._cond:
+            if len(self._waiting) >= self.max_queue:
+                raise QueueFullError(self.name, self._retry_after())
+            entry = (priority, client_id, next(self._seq))
+            self._waiting.append(entry)
+            deadline = time.monotonic() + self.timeout
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = deadline - now
+                    if self._active < self.max_concurrency and self._next_waiter() is entry:
+                        token_wait = self.bucket.try_take(now) if self.bucket else 0.0
+                        if token_wait == 0.0:
+                            break
+                        wait = min(wait, token_wait)
+                    if deadline - now <= 0:
+                        raise QueueFullError(self.name, self._retry_after())
+                    self._cond.wait(wait)
+            finally:
+                self._waiting.remove(entry)
+                self._cond.notify_all()
+            self._active += 1
+            self._active_by_client[client_id] = self._active_by_client.get(client_id, 0) + 1
+
+    def release(self, client_id: str, elapsed: float):
+        with self._cond:
+            self._active -= 1
+            remaining = self._active_by_client.get(client_id, 1) - 1
+            if remaining:
+                self._active_by_client[client_id] = remaining
+            else:
+                self._active_by_client.pop(client_id, None)
+            self._avg_service = 0.8 * self._avg_service + 0.2 * elapsed
+            self._cond.notify_all()
+
+
+def _env_int(name: str, default: int) -> int:
+    return int(os.getenv(name, default))
+
+
+_queue_timeout = float(os.getenv("QUEUE_TIMEOUT_SECONDS", 30))
+
+backends = {
+    "llm": Backend(
+        "llm",
+        max_concurrency=_env_int("LLM_MAX_CONCURRENCY", 4),
+        max_queue=_env_int("LLM_MAX_QUEUE", 32),
+        timeout=_queue_timeout,
+        rate_per_minute=float(os.getenv("LLM_RATE_PER_MINUTE", 15)),
+        burst=_env_int("LLM_BURST", 4),
+    ),
+    "postgres": Backend(
+        "postgres",
+        max_concurrency=_env_int("DB_MAX_CONCURRENCY", 8),
+        max_queue=_env_int("DB_MAX_QUEUE", 64),
+        timeout=_queue_timeout,
+    ),
+    "mysql": Backend(
+        "mysql",
+        max_concurrency=_env_int("DB_MAX_CONCURRENCY", 8),
+        max_queue=_env_int("DB_MAX_QUEUE", 64),
+        timeout=_queue_timeout,
+    ),
+}
+
+
+# Threads that may run scheduled work at once. By default every request a
+# backend may run or queue gets a thread, so admission (not a thread shortage)
+# decides when to answer 429.
+WORKER_THREADS = _env_int("WORKER_THREADS", sum(b.max_concurrency + b.max_queue for b in backends.values()))
+
+
+@contextmanager
+def client_context(client_id: str, priority: str = "interactive"):
+    """Tag every admission made inside the block with the given client and priority class."""
+    token = _client.set((client_id, PRIORITIES.get(priority, INTERACTIVE)))
+    try:
+        yield
+    finally:
+        _client.reset(token)
+
+
+@contextmanager
+def admit(backend: str):
+    """
+    Wait for a slot on `backend` for the current client, raising QueueFullError
+    if the queue is full or the wait exceeds the queue timeout.
+    """
+    client_id, priority = _client.get()
+    b = backends[backend]
+    b.acquire(client_id, priority)
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        b.release(client_id, time.monotonic() - start)
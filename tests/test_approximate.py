@@ -0,0 +1,31 @@
+import pytest
+
+pd = pytest.importorskip("pandas")
+import approximate  # noqa: E402
+
+
+@pytest.fixture
+def data(monkeypatch):
+    monkeypatch.setattr(approximate, "APPROX_MIN_SAMPLE_ROWS", 10)
+    return pd.DataFrame({"g": ["a", "b", "c", "d"] * 1000, "v": range(4000)})
+
+
+def test_empty_replicate_results_get_no_bounds(data):
+    def run(df):
+        # Rare groups: most small replicates return no rows, hence no columns
+        return df[df["v"] % 997 == 0].groupby("g")["v"].count().reset_index().to_dict(orient="records")
+
+    steps = list(approximate.progressive_execute(run, data, time_budget=60))
+    assert all("error" not in s for s in steps)
+    assert steps[-1]["exact"]
+
+
+def test_failing_step_is_reported_and_refinement_continues(data):
+    def run(df):
+        if len(df) < len(data):
+            raise RuntimeError("sample too sparse")
+        return [{"result": str(len(df))}]
+
+    steps = list(approximate.progressive_execute(run, data, time_budget=60))
+    assert all("Estimation failed: sample too sparse" == s["error"] for s in steps[:-1])
+    assert steps[-1]["exact"] and steps[-1]["results"] == [{"result": 4000}]
@@ -0,0 +1,122 @@
+import pytest
+from code_optimizer import optimize_code
+
+COLUMNS = ["table_name", "id", "amount", "price", "qty", "region", "created"]
+
+# (code, whether a rewrite applies, substring expected in the rewritten code)
+REWRITES = [
+    ("result = df.apply(lambda r: r['price'] * r['qty'], axis=1)", True, "df['price'] * df['qty']"),
+    ("result = df.apply(lambda r: f(r['price']), axis=1)", False, None),
+    ("total = 0\nfor _, row in df.iterrows():\n    total += row['amount']\nresult = total",
+     True, "if not df.empty and (df.dtypes == 'int64').all():\n    total += df['amount'].sum()"),
+    ("total = 0\nfor _, row in df.iterrows():\n    total += row['amount'] / 2\nresult = total", False, None),
+    ("total = 0\nfor i, row in df.iterrows():\n    total += row['amount'] * i\nresult = total", False, None),
+    ("df['created'] = pd.to_datetime(df['created'])\ndf['created'] = pd.to_datetime(df['created'])\nresult = df",
+     True, None),
+    ("a = df\nb = df\nm = a.merge(b, on='id')\nresult = m[m['id'] == 3]", True, "a[a['id'] == 3].merge(b[b['id'] == 3]"),
+    ("m = a.merge(b, on='id')\nresult = m[m['amount'] > 3]", False, None),
+    ("m = a.merge(b, on='id', how='left')\nresult = m[m['id'] == 3]", False, None),
+    ("unused = df['amount'] * 2\nresult = df", True, None),
+]
+
+
+@pytest.mark.parametrize("code,rewritten,expected", REWRITES)
+def test_rewrites(code, rewritten, expected):
+    new_code, _, applied = optimize_code(code)
+    assert bool(applied) == rewritten
+    if not rewritten:
+        assert new_code == code
+    if expected:
+        assert expected in new_code
+
+
+@pytest.mark.parametrize("code", [
+    # Index-sensitive uses of the filtered merge keep the original row labels
+    "m = a.merge(b, on='id')\nm = m[m['id'] == 3]\nresult = m.reset_index()",
+    "m = a.merge(b, on='id')\nresult = m[m['id'] == 3]\nresult = result.loc[5]",
+    "m = a.merge(b, on='id')\nf = m[m['id'] == 3]\nresult = f['amount']",
+])
+def test_merge_pushdown_skipped_when_index_is_used(code):
+    _, _, applied = optimize_code(code)
+    assert not any("merge" in a for a in applied)
+
+
+@pytest.mark.parametrize("code", [
+    "threshold = 5\nresult = df.query('amount > @threshold')",
+    "threshold = 5\nexpr = f'amount > {threshold}'\nresult = df.query(expr)",
+    "threshold = 5\nresult = df[df.eval('amount > @threshold')]",
+])
+def test_query_variables_are_live(code):
+    new_code, _, applied = optimize_code(code)
+    assert "threshold = 5" in new_code
+    assert not applied
+
+
+@pytest.mark.parametrize("code,touched", [
+    ("result = df[['region', 'amount']]", ["region", "amount"]),
+    ("result = df[df['qty'] > 1][['region', 'amount']]", ["amount", "qty", "region"]),
+    ("result = df.groupby('region')['amount'].sum()", ["amount", "region"]),
+    ("result = df.groupby('region')[['amount']].sum().reset_index()", ["amount", "region"]),
+    ("result = df['amount'].head(10)", ["amount"]),
+    ("result = df[df['amount'] > 5]", None),
+    ("result = df.drop(columns=['qty'])", None),
+    ("result = df.groupby('region').sum()", None),
+    ("result = df.head()", None),
+    ("result = df.describe()", None),
+    ("result = df.dropna()[['amount']]", None),
+    ("result = df[['amount']].join(df)", None),
+    ("result = df[['amount']]\nresult['qty'] = df['qty']", None),
+    ("result = df.iloc[:, 0:2][['amount']]", None),
+    ("result = df.corr()[['amount']]", None),
+    ("df['s'] = df.sum(axis=1)\nresult = df[['s']]", None),
+    ("x = df.to_numpy()\nresult = df[['amount']]", None),
+    ("x = df.values\nresult = df[['amount']]", None),
+    ("x = df.T\nresult = df[['amount']]", None),
+    ("df['t'] = df.apply(lambda r: r['price'] * r['qty'], axis=1)\nresult = df[['t']]", None),
+    ("df['t'] = df[['price', 'qty']].sum(axis=1)\nresult = df[['t']]", ["price", "qty"]),
+])
+def test_touched_columns(code, touched):
+    _, columns, _ = optimize_code(code, COLUMNS)
+    if touched is None:
+        assert columns is None
+    else:
+        assert sorted(columns) == sorted(touched)
+
+
+EQUIVALENT = [
+    "result = df.assign(total=df.apply(lambda r: r['price'] * r['qty'], axis=1))",
+    "result = df.apply(lambda r: r['price'] * r['qty'], axis=1)",
+    "result = df.apply(lambda r: r['qty'] > 2, axis=1)",
+    "total = 0\nfor _, row in df.iterrows():\n    total += row['price'] * row['qty']\nresult = total",
+    "total = 0\nfor _, row in df.iterrows():\n    total += row['qty'] * 3 - row['id']\nresult = total",
+    "m = df.merge(other, on='id')\nresult = m[m['id'].isin([1, 3])]",
+    "threshold = 2\nunused = df['qty'] * 2\nresult = df[df['qty'] > threshold]",
+]
+
+
+FRAMES = {
+    "mixed": {"id": [1, 2, 3, 3], "price": [1.5, 2.0, None, 4.0], "qty": [1, 2, 3, 4]},
+    "int": {"id": [1, 2, 3, 3], "price": [2, 5, 1, 7], "qty": [1, 2, 3, 4]},
+    "float": {"id": [1.0, 2.0, 3.0, 3.0], "price": [0.1, 0.2, None, 0.3], "qty": [1.0, 2.0, 3.0, 4.0]},
+    "empty": {"id": [], "price": [], "qty": []},
+}
+
+
+@pytest.mark.parametrize("frame", FRAMES)
+@pytest.mark.parametrize("code", EQUIVALENT)
+def test_rewritten_code_gives_identical_results(code, frame):
+    pd = pytest.importorskip("pandas")
+    df = pd.DataFrame(FRAMES[frame])
+    other = pd.DataFrame({"id": [3, 1, 3], "region": ["x", "y", "z"]})
+
+    def run(source):
+        local_vars = {"df": df.copy(), "other": other.copy(), "pd": pd}
+        exec(source, {}, local_vars)
+        result = local_vars["result"]
+        if isinstance(result, pd.DataFrame):
+            return repr(result.to_dict(orient="records")), repr(result.dtypes.to_dict())
+        return str(result), repr(result), getattr(result, "dtype", type(result))
+
+    new_code, _, applied = optimize_code(code)
+    assert applied
+    assert run(new_code) == run(code)
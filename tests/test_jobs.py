@@ -0,0 +1,223 @@
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+import pytest
+
+pd = pytest.importorskip("pandas")
+pytest.importorskip("pyarrow")
+from pydantic import BaseModel  # noqa: E402
+import jobs  # noqa: E402
+from scheduler import QueueFullError  # noqa: E402
+
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_DIR", str(tmp_path))
+    manager = jobs.JobManager(workers=1)
+    yield manager
+    manager._pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _wait(job, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while job.finished is None:
+        assert time.monotonic() < deadline, f"job still {job.status}"
+        time.sleep(0.01)
+    return job
+
+
+def _submit(manager, run):
+    return manager.submit("csv", "q", "client", run)
+
+
+def _blocking_run(started: threading.Event, release: threading.Event):
+    def run(job):
+        started.set()
+        release.wait(5)
+        yield [{"a": 1}]
+    return run
+
+
+def test_batches_are_spilled_and_read_back(manager):
+    job = _wait(_submit(manager, lambda job: iter([[{"a": 1}, {"a": 2}], [{"a": 3}]])))
+    assert (job.status, job.rows, job.parts) == (jobs.SUCCEEDED, 3, 2)
+    assert pd.concat(job.iter_frames())["a"].tolist() == [1, 2, 3]
+    assert job.head(2)["a"].tolist() == [1, 2]
+
+
+def test_mixed_columns_keep_nulls(manager):
+    job = _wait(_submit(manager, lambda job: iter([[{"v": 1}, {"v": "x"}, {"v": None}]])))
+    assert job.status == jobs.SUCCEEDED
+    assert next(job.iter_frames())["v"].isna().tolist() == [False, False, True]
+
+
+def test_empty_result_keeps_header(manager):
+    def run(job):
+        job.columns = ["a", "b"]
+        return iter([])
+
+    job = _wait(_submit(manager, run))
+    assert job.status == jobs.SUCCEEDED
+    assert list(job.head(10).columns) == ["a", "b"]
+
+
+def test_failure_is_reported(manager):
+    def run(job):
+        raise RuntimeError("boom")
+        yield
+
+    job = _wait(_submit(manager, run))
+    assert (job.status, job.error) == (jobs.FAILED, "boom")
+
+
+def test_cancel_queued_job_never_runs(manager):
+    started, release = threading.Event(), threading.Event()
+    blocker = _submit(manager, _blocking_run(started, release))
+    assert started.wait(5)
+    ran = []
+    queued = _submit(manager, lambda job: ran.append(1) or iter([]))
+    assert manager.cancel(queued.id).status == jobs.CANCELLED
+    release.set()
+    _wait(blocker)
+    manager._pool.shutdown(wait=True)
+    assert not ran and queued.status == jobs.CANCELLED
+
+
+def test_cancel_running_job_calls_hook(manager):
+    started, release = threading.Event(), threading.Event()
+
+    def run(job):
+        job.cancel_hook = release.set
+        started.set()
+        release.wait(5)
+        yield [{"a": 1}]
+
+    job = _submit(manager, run)
+    assert started.wait(5)
+    manager.cancel(job.id)
+    assert _wait(job).status == jobs.CANCELLED
+    assert job.rows == 0
+
+
+def test_cancel_finished_job_deletes_results(manager):
+    job = _wait(_submit(manager, lambda job: iter([[{"a": 1}]])))
+    manager.cancel(job.id)
+    assert manager.get(job.id) is None
+    assert not os.path.exists(job.dir)
+
+
+def test_finished_jobs_expire_after_ttl(manager, monkeypatch):
+    job = _wait(_submit(manager, lambda job: iter([[{"a": 1}]])))
+    assert manager.get(job.id) is job
+    monkeypatch.setattr(jobs, "JOB_TTL_SECONDS", 0.0)
+    job.finished -= 1
+    assert manager.get(job.id) is None
+    assert not os.path.exists(job.dir)
+
+
+def test_stuck_running_job_fails_then_expires(manager, monkeypatch):
+    started, release = threading.Event(), threading.Event()
+    job = _submit(manager, _blocking_run(started, release))
+    assert started.wait(5)
+    monkeypatch.setattr(jobs, "JOB_MAX_RUNTIME_SECONDS", 0.0)
+    job.started -= 1
+    manager.expire()
+    assert job.status == jobs.FAILED and "maximum runtime" in job.error
+    assert job.cancel_event.is_set()
+    release.set()
+    manager._pool.shutdown(wait=True)
+    # The worker returning later does not overwrite the outcome
+    assert job.status == jobs.FAILED
+    monkeypatch.setattr(jobs, "JOB_TTL_SECONDS", 0.0)
+    job.finished -= 1
+    assert manager.get(job.id) is None
+
+
+def test_orphaned_job_dirs_are_removed_after_ttl(manager, tmp_path, monkeypatch):
+    old, fresh = tmp_path / "old", tmp_path / "fresh"
+    old.mkdir()
+    fresh.mkdir()
+    os.utime(old, (time.time() - 7200, time.time() - 7200))
+    monkeypatch.setattr(jobs, "JOB_TTL_SECONDS", 3600.0)
+    job = _wait(_submit(manager, lambda job: iter([[{"a": 1}]])))
+    os.utime(job.dir, (time.time() - 7200, time.time() - 7200))
+    manager.expire()
+    assert not old.exists() and fresh.exists()
+    # Directories of known jobs are only removed through their own expiry
+    assert os.path.exists(job.dir)
+
+
+def test_full_queue_is_waited_out(manager):
+    attempts = []
+
+    def run(job):
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise QueueFullError("postgres", 0.01)
+        yield [{"a": 1}]
+
+    job = _wait(_submit(manager, run))
+    assert (job.status, job.rows, len(attempts)) == (jobs.SUCCEEDED, 1, 3)
+
+
+def test_full_queue_fails_after_wait_limit(manager, monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_QUEUE_WAIT_SECONDS", 0.05)
+
+    def run(job):
+        raise QueueFullError("postgres", 0.02)
+        yield
+
+    job = _wait(_submit(manager, run))
+    assert job.status == jobs.FAILED and "busy" in job.error
+
+
+class _State(BaseModel):
+    user_input: str
+    sql_query: Optional[str] = ""
+    results: List[Dict] = []
+    template_hit: bool = False
+    template_rejected: bool = False
+
+
+class _Agent:
+    """Stands in for the SQL agents: a template hit for 'empty' finds no rows, the LLM's query does."""
+
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+        self.tracked = []
+
+    def generate_sql(self, state):
+        state.results = []
+        if state.template_rejected:
+            state.template_hit, state.sql_query = False, "SELECT generated"
+        else:
+            state.template_hit, state.sql_query = True, "SELECT template"
+        return state
+
+    def iter_query(self, state, batch_size, on_connect=None, on_columns=None):
+        if self.fail:
+            raise RuntimeError("syntax error")
+        if state.sql_query == "SELECT generated":
+            yield [{"a": 1}, {"a": 2}]
+
+    def track_execution(self, state, sql, execution_ms, plan=None, row_count=None):
+        failed = bool(state.results) and "error" in state.results[0]
+        if state.template_hit and (failed or not row_count):
+            state.template_rejected = True
+        self.tracked.append((sql, failed, row_count))
+
+
+def test_sql_job_tracks_and_regenerates_empty_template_hits(manager):
+    agent = _Agent()
+    job = _wait(manager.submit("postgres", "q", "client", jobs.sql_job(agent, _State(user_input="q"))))
+    assert (job.status, job.rows) == (jobs.SUCCEEDED, 2)
+    assert agent.tracked == [("SELECT template", False, 0), ("SELECT generated", False, 2)]
+
+
+def test_sql_job_tracks_failures(manager):
+    agent = _Agent(fail=True)
+    job = _wait(manager.submit("postgres", "q", "client", jobs.sql_job(agent, _State(user_input="q"))))
+    assert job.status == jobs.FAILED
+    assert [(sql, failed) for sql, failed, _ in agent.tracked] == [("SELECT template", True),
+                                                                   ("SELECT generated", True)]
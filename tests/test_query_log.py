@@ -0,0 +1,94 @@
+import pytest
+import query_log
+
+
+@pytest.fixture
+def log_path(tmp_path, monkeypatch):
+    path = tmp_path / "slow.jsonl"
+    monkeypatch.setattr(query_log, "SLOW_QUERY_LOG_PATH", str(path))
+    monkeypatch.setattr(query_log, "SLOW_QUERY_THRESHOLD_MS", 100.0)
+    monkeypatch.setattr(query_log, "enabled", True)
+    return path
+
+
+def _record(**overrides):
+    args = dict(backend="csv", question="q", fingerprint="f", generated="result = df",
+                generation_ms=None, execution_ms=150.0, results=[{"a": 1}, {"a": 2}])
+    args.update(overrides)
+    query_log.record(**args)
+
+
+@pytest.mark.parametrize("generation_ms,execution_ms,logged", [
+    (None, None, False),
+    (50.0, 99.9, False),
+    (None, 100.0, True),
+    (150.0, None, True),
+    (150.0, 10.0, True),
+    (10.0, 150.0, True),
+])
+def test_threshold(log_path, generation_ms, execution_ms, logged):
+    _record(generation_ms=generation_ms, execution_ms=execution_ms)
+    assert log_path.exists() == logged
+
+
+def test_disabled_log_records_nothing(log_path, monkeypatch):
+    monkeypatch.setattr(query_log, "enabled", False)
+    _record()
+    assert not log_path.exists()
+
+
+@pytest.mark.parametrize("results,row_count,expected_rows,expected_error", [
+    ([{"a": 1}, {"a": 2}], None, 2, None),
+    ([], None, 0, None),
+    # Streamed exports record no rows but report how many were sent
+    ([], 5000, 5000, None),
+    ([{"a": 1}], 5000, 5000, None),
+    ([{"error": "Execution error: boom", "code": "x"}], None, None, "Execution error: boom"),
+    ([{"error": "Execution error: boom"}], 5000, None, "Execution error: boom"),
+    (["not a record"], None, 1, None),
+])
+def test_row_count_and_error(log_path, results, row_count, expected_rows, expected_error):
+    _record(results=results, row_count=row_count, touched_columns=["a"])
+    [entry] = query_log.load_entries(str(log_path))
+    assert entry["row_count"] == expected_rows
+    assert entry["error"] == expected_error
+    assert entry["touched_columns"] == ["a"]
+
+
+def test_record_never_raises(tmp_path, monkeypatch):
+    monkeypatch.setattr(query_log, "SLOW_QUERY_LOG_PATH", str(tmp_path / "missing" / "slow.jsonl"))
+    monkeypatch.setattr(query_log, "SLOW_QUERY_THRESHOLD_MS", 0.0)
+    monkeypatch.setattr(query_log, "enabled", True)
+    _record()
+
+
+def test_csv_entry_replay_round_trip(log_path, tmp_path, monkeypatch, capsys):
+    pd = pytest.importorskip("pandas")
+    pytest.importorskip("google.generativeai")
+    pytest.importorskip("langgraph")
+    monkeypatch.setenv("GOOGLE_API_KEY", "test")
+    from query_templates import template_store
+    import utils
+
+    monkeypatch.setattr(template_store, "enabled", False)
+    data = tmp_path / "orders.csv"
+    pd.DataFrame({"region": ["north", "south", "north"], "amount": [1, 2, 3]}).to_csv(data, index=False)
+    schema = utils.get_csv_schema(pd.read_csv(data))
+    _record(question="orders in a region", fingerprint=query_log.schema_fingerprint(schema),
+            generated="result = df[df['region'] == region]", params={"region": "north"},
+            results=[{"region": "north", "amount": 1}, {"region": "north", "amount": 3}])
+
+    query_log.main(["--log", str(log_path), "--backend", "csv", "--data", str(data)])
+    out = capsys.readouterr().out
+    assert "rows 2 -> 2" in out
+    assert "question: orders in a region" in out
+    assert "schema changed" not in out
+    assert "error" not in out
+    # Replays are not logged again
+    assert len(query_log.load_entries(str(log_path))) == 1
+
+
+def test_csv_replay_requires_data(log_path, capsys):
+    _record()
+    query_log.main(["--log", str(log_path), "--backend", "csv"])
+    assert "requires --data" in capsys.readouterr().out
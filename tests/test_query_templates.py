@@ -0,0 +1,213 @@
+import pytest
+from query_templates import TemplateStore
+
+SCHEMA = "Tables and columns:\ncustomers: id, name, city\norders: id, customer_id, amount, created"
+
+# (backend, learned question, generated query, new question, expected params or None for a miss)
+ROUND_TRIPS = [
+    ("postgres", "total orders for customer bob",
+     "SELECT count(*) FROM orders o JOIN customers c ON c.id = o.customer_id WHERE lower(c.name) = lower('bob')",
+     "total orders for customer alice", {"p0": "alice"}),
+    ("postgres", "total orders for customer bob",
+     "SELECT count(*) FROM orders o JOIN customers c ON c.id = o.customer_id WHERE lower(c.name) = lower('bob')",
+     "please show me the total orders for customer alice", {"p0": "alice"}),
+    # Extra qualifiers must not end up inside a string slot
+    ("postgres", "total orders for customer bob",
+     "SELECT count(*) FROM orders o JOIN customers c ON c.id = o.customer_id WHERE lower(c.name) = lower('bob')",
+     "total orders for customer alice in 2023", None),
+    ("postgres", "customers not named bob",
+     "SELECT name FROM customers WHERE name <> 'bob'",
+     "customers not named bob or alice", None),
+    ("postgres", "customers named 'bob smith'",
+     "SELECT * FROM customers WHERE name = 'bob smith'",
+     "customers named 'alice in wonderland'", {"p0": "alice in wonderland"}),
+    ("postgres", "customers named 'bob smith'",
+     "SELECT * FROM customers WHERE name = 'bob smith'",
+     "customers named alice", None),
+    ("postgres", "customers in city london",
+     "SELECT name FROM customers WHERE city ILIKE '%london%'",
+     "customers in city paris", {"p0": "%paris%"}),
+    ("postgres", "top 5 customers by amount",
+     "SELECT customer_id, sum(amount) FROM orders GROUP BY 1 ORDER BY 2 DESC LIMIT 5",
+     "top 12 customers by amount", {"p0": 12}),
+    ("postgres", "top 5 customers by amount",
+     "SELECT customer_id, sum(amount) FROM orders GROUP BY 1 ORDER BY 2 DESC LIMIT 5",
+     "top ten customers by amount", None),
+    ("postgres", "top 5 customers by amount",
+     "SELECT customer_id, sum(amount) FROM orders GROUP BY 1 ORDER BY 2 DESC LIMIT 5",
+     "bottom 5 customers by amount", None),
+    ("mysql", "orders over 100.5",
+     "SELECT id FROM orders WHERE amount > 100.5",
+     "orders over 7", {"p0": 7.0}),
+    ("csv", "rows where city is london",
+     "result = df[df['city'] == 'london']",
+     "rows where city is paris", {"_p0": "paris"}),
+    ("csv", "orders above 10",
+     "result = df[df['amount'].apply(lambda a: a > 10)]",
+     "orders above 25", {"_p0": 25}),
+    # Qualifiers and filler words are never slot values
+    ("postgres", "how many active customers",
+     "SELECT count(*) FROM customers WHERE status = 'active'",
+     "how many inactive customers", {"p0": "inactive"}),
+    ("postgres", "how many active customers",
+     "SELECT count(*) FROM customers WHERE status = 'active'",
+     "how many total customers", None),
+    ("postgres", "how many active customers",
+     "SELECT count(*) FROM customers WHERE status = 'active'",
+     "how many all customers", None),
+    ("postgres", "how many active customers",
+     "SELECT count(*) FROM customers WHERE status = 'active'",
+     "how many the customers", None),
+    # The case the LLM gave the learned value is given to bound values too
+    ("postgres", "customers in city london",
+     "SELECT name FROM customers WHERE city = 'London'",
+     "customers in city new_york", {"p0": "New_York"}),
+    ("postgres", "customers in city london",
+     "SELECT name FROM customers WHERE city = 'LONDON'",
+     "customers in city paris", {"p0": "PARIS"}),
+    ("postgres", "customers in city London",
+     "SELECT name FROM customers WHERE city = 'london'",
+     "customers in city Paris", {"p0": "paris"}),
+    ("postgres", "customers in city London",
+     "SELECT name FROM customers WHERE city = 'London'",
+     "customers in city paris", {"p0": "paris"}),
+    ("postgres", "customers named 'bob smith'",
+     "SELECT * FROM customers WHERE name = 'Bob Smith'",
+     "customers named 'alice jones'", {"p0": "Alice Jones"}),
+]
+
+
+@pytest.fixture
+def store(tmp_path):
+    return TemplateStore(str(tmp_path / "templates.json"))
+
+
+@pytest.mark.parametrize("backend,question,query,new_question,expected", ROUND_TRIPS)
+def test_learn_match_round_trip(store, backend, question, query, new_question, expected):
+    store.learn(backend, SCHEMA, question, query)
+    assert store.stats()["templates"] == 1
+    # The learned question itself always matches and binds its own values
+    assert store.match(backend, SCHEMA, question) is not None
+    hit = store.match(backend, SCHEMA, new_question)
+    if expected is None:
+        assert hit is None
+    else:
+        assert hit is not None
+        assert hit["params"] == expected
+
+
+@pytest.mark.parametrize("backend,question,query", [
+    # The same value twice in the question: which literal belongs to which is unknown
+    ("postgres", "top 5 customers with more than 5 orders",
+     "SELECT customer_id FROM orders GROUP BY 1 HAVING count(*) > 5 ORDER BY count(*) DESC LIMIT 5"),
+    ("postgres", "orders of bob shipped to bob",
+     "SELECT id FROM orders WHERE buyer = 'bob'"),
+    # A literal computed from a number in the question would go stale
+    ("postgres", "orders in 2024",
+     "SELECT id FROM orders WHERE created >= '2024-01-01' AND created < '2025-01-01'"),
+    # Looks like a driver placeholder to mysql-connector
+    ("mysql", "orders by bob",
+     "SELECT id FROM orders WHERE buyer = 'bob' AND note <> '%(x)s'"),
+    # No case transform turns "mcdonald" into 'McDonald'
+    ("postgres", "customers named mcdonald",
+     "SELECT id FROM customers WHERE name = 'McDonald'"),
+])
+def test_not_learned(store, backend, question, query):
+    store.learn(backend, SCHEMA, question, query)
+    assert store.stats()["templates"] == 0
+
+
+@pytest.mark.parametrize("backend,template", [
+    ("postgres", "SELECT id FROM orders WHERE to_char(created, '%%Y') = '2024' AND buyer = %(p0)s"),
+    ("mysql", "SELECT id FROM orders WHERE DATE_FORMAT(created, '%Y') = '2024' AND buyer = %(p0)s"),
+])
+def test_percent_escaping_per_backend(store, backend, template):
+    query = template.replace("%(p0)s", "'bob'").replace("%%", "%")
+    store.learn(backend, SCHEMA, "orders by bob", query)
+    hit = store.match(backend, SCHEMA, "orders by alice")
+    assert hit["query"] == template
+    assert hit["params"] == {"p0": "alice"}
+
+
+def test_unparameterized_sql_is_kept_verbatim(store):
+    query = "SELECT id FROM orders WHERE note LIKE '%rush%'"
+    store.learn("postgres", SCHEMA, "urgent orders", query)
+    assert store.match("postgres", SCHEMA, "urgent orders")["query"] == query
+
+
+def test_other_schema_or_backend_misses(store):
+    store.learn("postgres", SCHEMA, "customers in city london", "SELECT name FROM customers WHERE city = 'london'")
+    assert store.match("mysql", SCHEMA, "customers in city paris") is None
+    assert store.match("postgres", SCHEMA + ", email", "customers in city paris") is None
+
+
+def test_forget_and_persistence(tmp_path):
+    path = str(tmp_path / "templates.json")
+    query = "SELECT name FROM customers WHERE city = 'london'"
+    TemplateStore(path).learn("postgres", SCHEMA, "customers in city london", query)
+    store = TemplateStore(path)
+    hit = store.match("postgres", SCHEMA, "customers in city paris")
+    assert hit["params"] == {"p0": "paris"}
+    store.forget("postgres", SCHEMA, hit["query"])
+    assert TemplateStore(path).match("postgres", SCHEMA, "customers in city paris") is None
+
+
+def test_rejected_hit_counts_as_miss(store):
+    store.learn("postgres", SCHEMA, "customers in city london", "SELECT name FROM customers WHERE city = 'london'",
+                generation_ms=800.0)
+    hit = store.match("postgres", SCHEMA, "customers in city paris")
+    store.reject("postgres", SCHEMA, hit["query"])
+    stats = store.stats()
+    assert (stats["hits"], stats["misses"], stats["saved_ms"]) == (0, 1, 0.0)
+    # A rejected template stays; a value that finds rows may come along later
+    assert store.match("postgres", SCHEMA, "customers in city rome") is not None
+
+
+def test_template_without_case_is_not_bound(store):
+    store.learn("postgres", SCHEMA, "customers in city london", "SELECT name FROM customers WHERE city = 'london'")
+    for p in store._templates[0]["params"]:
+        del p["case"]
+    assert store.match("postgres", SCHEMA, "customers in city paris") is None
+
+
+def test_csv_template_hit_without_rows_is_regenerated(store, monkeypatch):
+    pd = pytest.importorskip("pandas")
+    pytest.importorskip("google.generativeai")
+    pytest.importorskip("langgraph")
+    monkeypatch.setenv("GOOGLE_API_KEY", "test")
+    import csv_module
+    import query_log
+
+    monkeypatch.setattr(csv_module, "template_store", store)
+    monkeypatch.setattr(query_log, "enabled", False)
+    generated = []
+
+    def llm_invoke(prompt):
+        generated.append(prompt)
+        return "result = df[df['city'].str.lower() == 'paris']"
+
+    monkeypatch.setattr(csv_module, "llm_invoke", llm_invoke)
+    store.learn("csv", SCHEMA, "rows where city is london", "result = df[df['city'] == 'London']")
+    df = pd.DataFrame({"city": ["London", "paris"]})
+    workflow = csv_module.CSVQueryAgent().get_workflow()
+    result = workflow.invoke({"user_input": "rows where city is paris", "csv_schema": SCHEMA, "df": df})
+    assert len(generated) == 1
+    assert result["results"] == [{"city": "paris"}]
+    assert not result["template_hit"]
+    assert store.stats()["misses"] == 1
+
+
+def test_disabled_store_neither_learns_nor_forgets(store):
+    store.enabled = False
+    store.learn("postgres", SCHEMA, "customers in city london", "SELECT name FROM customers WHERE city = 'london'")
+    assert store.stats()["templates"] == 0
+
+
+def test_pandas_template_params_reach_nested_scopes(store):
+    pd = pytest.importorskip("pandas")
+    store.learn("csv", SCHEMA, "orders above 10", "result = df[df['amount'].apply(lambda a: a > 10)]")
+    hit = store.match("csv", SCHEMA, "orders above 25")
+    local_vars = {"df": pd.DataFrame({"amount": [5, 20, 30]}), "pd": pd}
+    # Bound the way the CSV and Excel agents bind them
+    exec(hit["query"], dict(hit["params"]), local_vars)
+    assert local_vars["result"]["amount"].tolist() == [30]
@@ -0,0 +1,105 @@
+import threading
+import time
+import pytest
+from scheduler import Backend, TokenBucket, QueueFullError, INTERACTIVE, BATCH
+
+
+def _wait_until(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError("condition not reached")
+        time.sleep(0.001)
+
+
+def _admission_order(backend: Backend, waiters):
+    """
+    Holds the only slot while `waiters` ((client_id, priority) pairs) queue up in
+    order, then releases it and returns the order in which they were admitted.
+    """
+    order, lock = [], threading.Lock()
+    backend.acquire("holder", INTERACTIVE)
+
+    def wait(name, client_id, priority):
+        backend.acquire(client_id, priority)
+        with lock:
+            order.append(name)
+        backend.release(client_id, 0.0)
+
+    threads = []
+    for n, (client_id, priority) in enumerate(waiters):
+        t = threading.Thread(target=wait, args=(n, client_id, priority))
+        t.start()
+        threads.append(t)
+        _wait_until(lambda: len(backend._waiting) == n + 1)
+    backend.release("holder", 0.0)
+    for t in threads:
+        t.join(2)
+    return order
+
+
+def test_interactive_requests_are_admitted_before_batch():
+    backend = Backend("db", max_concurrency=1, max_queue=10, timeout=5)
+    order = _admission_order(backend, [("a", BATCH), ("b", BATCH), ("c", INTERACTIVE), ("d", INTERACTIVE)])
+    assert order == [2, 3, 0, 1]
+
+
+def test_clients_with_fewer_running_requests_go_first():
+    backend = Backend("db", max_concurrency=2, max_queue=10, timeout=5)
+    # "busy" already has a request running on the second slot
+    backend.acquire("busy", INTERACTIVE)
+    order = _admission_order(backend, [("busy", INTERACTIVE), ("busy", INTERACTIVE), ("quiet", INTERACTIVE)])
+    assert order[0] == 2
+    backend.release("busy", 0.0)
+
+
+def test_same_class_and_load_is_first_come_first_served():
+    backend = Backend("db", max_concurrency=1, max_queue=10, timeout=5)
+    assert _admission_order(backend, [("a", BATCH), ("b", BATCH), ("c", BATCH)]) == [0, 1, 2]
+
+
+def test_full_queue_fails_fast_with_retry_after():
+    backend = Backend("db", max_concurrency=1, max_queue=1, timeout=5)
+    backend.acquire("a", INTERACTIVE)
+    waiter = threading.Thread(target=lambda: (backend.acquire("b", INTERACTIVE), backend.release("b", 0.0)))
+    waiter.start()
+    _wait_until(lambda: len(backend._waiting) == 1)
+    start = time.monotonic()
+    with pytest.raises(QueueFullError) as e:
+        backend.acquire("c", INTERACTIVE)
+    assert time.monotonic() - start < 0.5
+    assert e.value.backend == "db" and e.value.retry_after >= 1
+    backend.release("a", 0.0)
+    waiter.join(2)
+
+
+def test_queue_timeout_raises_and_leaves_the_queue():
+    backend = Backend("db", max_concurrency=1, max_queue=5, timeout=0.05)
+    backend.acquire("a", INTERACTIVE)
+    with pytest.raises(QueueFullError) as e:
+        backend.acquire("b", INTERACTIVE)
+    assert e.value.retry_after >= 1
+    assert backend._waiting == []
+    backend.release("a", 0.0)
+    backend.acquire("b", INTERACTIVE)
+
+
+def test_token_bucket_paces_admissions():
+    # 1200/minute = one token every 50 ms after a burst of 2
+    backend = Backend("llm", max_concurrency=10, max_queue=10, timeout=5, rate_per_minute=1200, burst=2)
+    start = time.monotonic()
+    admitted = []
+    for _ in range(4):
+        backend.acquire("a", INTERACTIVE)
+        admitted.append(time.monotonic() - start)
+        backend.release("a", 0.0)
+    assert admitted[1] < 0.03
+    assert admitted[2] >= 0.04 and admitted[3] >= 0.09
+
+
+def test_token_bucket_reports_wait():
+    bucket = TokenBucket(rate_per_minute=60, burst=1)
+    now = time.monotonic()
+    assert bucket.try_take(now) == 0.0
+    assert bucket.try_take(now) == pytest.approx(1.0, abs=0.01)
+    assert bucket.try_take(now + 1.0) == 0.0
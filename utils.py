@@ -1,6 +1,9 @@
 import google.generativeai as genai
 import os
+import re
+from typing import Optional
 from dotenv import load_dotenv
+from scheduler import admit
 
 load_dotenv(override=True)
 google_api_key = os.getenv('GOOGLE_API_KEY')
@@ -11,7 +14,8 @@ genai.configure(api_key=google_api_key)
 model = genai.GenerativeModel('gemini-2.0-flash')
 
 def llm_invoke(prompt: str) -> str:
-    response = model.generate_content(prompt)
+    with admit("llm"):
+        response = model.generate_content(prompt)
     if hasattr(response, "text") and response.text:
         return response.text.strip()
     try:
@@ -19,6 +23,21 @@ def llm_invoke(prompt: str) -> str:
     except Exception:
         return ""
 
+def clean_select(sql: str) -> Optional[str]:
+    """
+    Returns the generated SQL without code fences or a trailing semicolon if it is
+    a single read-only SELECT (or WITH ... SELECT) statement, otherwise None.
+    """
+    sql = (sql or "").strip()
+    if sql.startswith("```"):
+        sql = sql.lstrip("`").replace("sql", "", 1).strip().rstrip("`").strip()
+    sql = sql.rstrip(";").strip()
+    if ";" in sql or not re.match(r"(?is)^(select|with)\b", sql):
+        return None
+    if re.search(r"(?i)\b(insert|update|delete|merge|drop|alter|create|truncate|grant|revoke)\b", sql):
+        return None
+    return sql
+
 def get_csv_schema(df):
     return "\n".join([f"Column: {col} ({str(dtype)})" for col, dtype in df.dtypes.items()])
 